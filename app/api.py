@@ -1,53 +1,385 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, request, jsonify, stream_with_context
+import itertools
 import os
-from pymongo import MongoClient
+import signal
+import threading
+import time
+from pymongo import MongoClient, ASCENDING, DESCENDING
+from bson import ObjectId
 import json
-from openai import OpenAI
 from flask_cors import CORS
-import pandas as pd
 import numpy as np
-from sklearn.preprocessing import LabelEncoder
-import pickle
+from scoring import ModelManager, model_artifact_path, scorer_from_env
+from explanations import ExplanationJobs
+from cache import ExplanationCache
+from features import FEATURE_COLUMNS, FEATURE_PROJECTION, build_feature_matrix, fetch_users_feature_matrix, mean_by_key
+from prompts import SUMMARY_FIELDS, SUMMARY_PROJECTION, summarize_history
+from metrics import Metrics
+from ingest import WriteBehindBuffer, validate_fingerprint, write_concern_from_env
+import buckets
 
 
 app = Flask(__name__)
 CORS(app, resources={r"/*": {"origins": "http://localhost:3000"}})
 
 
+# Per-stage timers and counters for /metrics; METRICS_SERVER_TIMING=1 also reports the
+# stages of each request in a Server-Timing header. Workers of a pre-fork server share
+# their metrics through METRICS_MULTIPROC_DIR (gunicorn.conf.py sets it)
+metrics = Metrics(
+    enabled=os.getenv("METRICS_ENABLED", "1") == "1",
+    server_timing=os.getenv("METRICS_SERVER_TIMING", "0") == "1",
+    multiprocess_dir=os.getenv("METRICS_MULTIPROC_DIR") or None
+)
+
+
 mongo_uri = os.getenv("MONGO_URI")
-client = MongoClient(mongo_uri)
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", "100"))
+client = MongoClient(mongo_uri, maxPoolSize=MONGO_MAX_POOL_SIZE)
 db = client.get_default_database()
 collection = db["fingerprints"]
 
 
-MODEL_PATH = "rf_regressor_model.pkl"
-with open(MODEL_PATH, 'rb') as f:
-    rf_model = pickle.load(f)
+# "bucketed" stores and reads fingerprints as per-user time buckets (see buckets.py,
+# which also migrates existing data) instead of one document per fingerprint
+STORAGE_LAYOUT = os.getenv("STORAGE_LAYOUT", "documents")
+buckets_collection = db["fingerprint_buckets"]
+
+
+ACTIVITY_SORT = [("timestamp", ASCENDING), ("_id", ASCENDING)]
+ACTIVITY_BATCH_SIZE = int(os.getenv("ACTIVITY_BATCH_SIZE", "500"))
+
 
+MODEL_CANARY_SIZE = int(os.getenv("MODEL_CANARY_SIZE", "500"))
 
-openai_client = OpenAI(
-    api_key=os.getenv("GROK_API_KEY"),
-    base_url="https://api.x.ai/v1"
+
+def canary_features():
+    """Features of the newest fingerprints, which a new model must score sensibly to go live."""
+    try:
+        if STORAGE_LAYOUT == "bucketed":
+            newest = buckets_collection.find({}, {"userId": 1, "count": 1, "timestamp": 1, "features": 1})
+            features, _, _ = buckets.unpack_features(newest.sort("end", DESCENDING).limit(10))
+            return features[:MODEL_CANARY_SIZE]
+        cursor = collection.find({}, FEATURE_PROJECTION).sort("_id", DESCENDING).limit(MODEL_CANARY_SIZE)
+        return build_feature_matrix(cursor, capacity=MODEL_CANARY_SIZE)
+    except Exception as e:
+        print(f"Could not fetch canary fingerprints: {str(e)}")
+        return None
+
+
+# Handlers read models.current once per request; a new artifact is swapped in when the file
+# changes (every MODEL_WATCH_INTERVAL seconds), on SIGHUP or via /admin/model/reload.
+# With several processes, MODEL_STATE_PATH carries admin reloads and rollbacks to the
+# others, which follow within MODEL_STATE_INTERVAL seconds
+models = ModelManager(
+    lambda cache: scorer_from_env(cache=cache),
+    model_artifact_path(),
+    canary=canary_features,
+    max_drift=float(os.getenv("MODEL_CANARY_MAX_DRIFT", "25")),
+    state_path=os.getenv("MODEL_STATE_PATH") or None
 )
+MODEL_WATCH_INTERVAL = float(os.getenv("MODEL_WATCH_INTERVAL", "0"))
+MODEL_STATE_INTERVAL = float(os.getenv("MODEL_STATE_INTERVAL", "2"))
+try:
+    signal.signal(signal.SIGHUP, lambda signum, frame: threading.Thread(target=models.reload, daemon=True).start())
+except ValueError:
+    pass  # Not imported from the main thread
+
+
+# Read scores kept up to date by score_worker.py, scoring on the fly only for users it hasn't seen.
+# The worker only reads the fingerprints collection, so its aggregates would go stale once
+# fingerprints are written to buckets
+USE_SCORE_AGGREGATES = os.getenv("USE_SCORE_AGGREGATES", "0") == "1"
+if USE_SCORE_AGGREGATES and STORAGE_LAYOUT == "bucketed":
+    print("USE_SCORE_AGGREGATES is ignored with STORAGE_LAYOUT=bucketed; scoring on the fly")
+    USE_SCORE_AGGREGATES = False
+user_scores = db["user_scores"]
+AGGREGATE_PROJECTION = {"_id": 0, "userId": 1, "sum": 1, "count": 1, "firstTimestamp": 1, "lastTimestamp": 1}
+
+
+def aggregated_scores(user_ids, scorer):
+    """(average score, count, first and last timestamp) by userId, from the user_scores aggregates
+    of the scorer's model version; the first timestamp is None on aggregates from before it was kept."""
+    if not USE_SCORE_AGGREGATES:
+        return {}
+    cursor = user_scores.find({"userId": {"$in": list(user_ids)}, "modelVersion": scorer.version},
+                              AGGREGATE_PROJECTION)
+    return {
+        doc["userId"]: (doc["sum"] / doc["count"], doc["count"], doc.get("firstTimestamp"), doc.get("lastTimestamp"))
+        for doc in cursor if doc["count"]
+    }
+
+
+# Created on first use: importing openai alone takes about half a second
+openai_client = None
+openai_client_lock = threading.Lock()
+
+
+def get_openai_client():
+    global openai_client
+    with openai_client_lock:
+        if openai_client is None:
+            from openai import OpenAI
+            # The SDK's own retries would retry timeouts too, stretching LLM_TIMEOUT and the
+            # job deadline to several times their value while a pool slot is held
+            openai_client = OpenAI(
+                api_key=os.getenv("GROK_API_KEY"),
+                base_url=os.getenv("GROK_BASE_URL", "https://api.x.ai/v1"),
+                max_retries=0
+            )
+        return openai_client
+
+
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "30"))
+
+
+MAX_BATCH_USERS = int(os.getenv("MAX_BATCH_USERS", "5000"))
+
+
+def explain_score(avg_score, features, user_records, timeout=LLM_TIMEOUT):
+    """Ask the LLM to explain a user's score to customer services."""
+    with metrics.stage("prompt"):
+        user_data_str = summarize_history(features, user_records)
+
+
+    prompt = f"""
+    You are an expert in spotting gambling patterns, talking to your customer services colleagues. 
+    I’ve already calculated a score for this user: {avg_score} (0 means a sharp, pro bettor; 100 means a casual, everyday punter).
+    Based on this score and the user data below, explain in a simple, human-friendly way why this user got this score. 
+    Keep it short, clear, and easy to read, avoiding overly techy terms or long lists.
+    Your explanation will help a customer service rep decide next steps for this user.
+
+    Sharp bettors (closer to 0) tend to:
+    - Hide their tracks (e.g., headless browsers, no cookies)
+    - Load pages super fast (under 200ms)
+    - Use powerful gear (lots of CPU cores and memory)
+    - Barely interact (few clicks or scrolls)
+    - Stick to the same setup consistently
+    - Use datacenter IPs (like pros hiding their location)
+
+    Casual punters (closer to 100) tend to:
+    - Browse normally (no hiding, cookies on)
+    - Load pages at average speed (over 300ms)
+    - Use regular home computers
+    - Click and scroll a lot
+    - Change setups often
+    - Use home internet
+
+    User Data (summary of their history):
+    {user_data_str}
+
+    Give your answer as a reason that is no longer than 4 to 5 sentences.
+    """
+
+    metrics.inc("prompt_chars", len(prompt))
+    with metrics.stage("llm"):
+        response = get_openai_client().chat.completions.create(
+            model="grok-2",
+            messages=[
+                {"role": "system", "content": "You are Grok, a gambling behavior analyst."},
+                {"role": "user", "content": prompt}
+            ],
+            max_tokens=150,
+            temperature=0.7,
+            timeout=timeout,
+        )
+    if response.usage is not None:
+        metrics.inc("llm_tokens", response.usage.prompt_tokens, "prompt")
+        metrics.inc("llm_tokens", response.usage.completion_tokens, "completion")
+    return response.choices[0].message.content
 
 
-FEATURE_COLUMNS = [
-    "headless", "cookiesEnabled", "pageLoadTime",
-    "event_mousemove", "event_keydown", "event_scroll", "event_copy",
-    "ip_is_datacenter", "screen_width", "screen_height",
-    "screen_devicePixelRatio", "viewport_innerWidth", "viewport_innerHeight",
-    "battery_level", "battery_charging", "battery_chargingTime",
-    "hardware_cpuCores", "hardware_deviceMemory"
-]
+explanation_cache = ExplanationCache(
+    maxsize=int(os.getenv("EXPLANATION_CACHE_SIZE", "10000")),
+    ttl=float(os.getenv("EXPLANATION_CACHE_TTL", "900")),
+    score_bucket=int(os.getenv("EXPLANATION_SCORE_BUCKET", "5")),
+    collection=db["explanation_cache"] if os.getenv("EXPLANATION_CACHE_SHARED", "0") == "1" else None
+)
 
 
-le_dict = {}
+def explain_user(user_id, avg_score, features, user_records, timeout=LLM_TIMEOUT):
+    """explain_score, reusing a cached explanation while the user's records are unchanged."""
+    key = explanation_cache.key(user_id, avg_score, user_records)
+    reason = explanation_cache.get(key)
+    if reason is None:
+        reason = explain_and_cache(key, avg_score, features, user_records, timeout=timeout)
+    return reason
+
+
+def explain_and_cache(key, avg_score, features, user_records, timeout=LLM_TIMEOUT):
+    """explain_score, storing the explanation under key; for callers that have already missed the cache."""
+    start_time = time.monotonic()
+    reason = explain_score(avg_score, features, user_records, timeout=timeout)
+    explanation_cache.put(key, reason, time.monotonic() - start_time)
+    return reason
+
+
+# In "async" mode /limit-increase answers with the score straight away and a job id for the
+# explanation; "sync" waits for the LLM. Requests can choose either with {"async": true/false}
+EXPLANATION_MODE = os.getenv("EXPLANATION_MODE", "sync")
+SSE_KEEPALIVE = 15.0
+explanation_jobs = ExplanationJobs(
+    explain_and_cache,
+    max_workers=int(os.getenv("EXPLANATION_WORKERS", "4")),
+    max_pending=int(os.getenv("EXPLANATION_MAX_PENDING", "64")),
+    deadline=float(os.getenv("EXPLANATION_DEADLINE", "20")),
+    collection=db["explanation_jobs"]
+)
 
 
-for col in ["headless", "cookiesEnabled", "event_mousemove", "event_keydown",
-            "event_scroll", "event_copy", "ip_is_datacenter", "battery_charging"]:
-    le_dict[col] = LabelEncoder()
-    le_dict[col].fit([0, 1])
+# POST /fingerprints buffers events and writes them in unordered batches; with
+# INGEST_WRITE_CONCERN=0 writes are not acknowledged at all, "majority" waits for replicas
+ingest_buffer = WriteBehindBuffer(
+    buckets_collection if STORAGE_LAYOUT == "bucketed" else collection,
+    max_batch=int(os.getenv("INGEST_BATCH_SIZE", "1000")),
+    flush_interval=float(os.getenv("INGEST_FLUSH_INTERVAL", "0.05")),
+    max_buffered=int(os.getenv("INGEST_MAX_BUFFERED", "50000")),
+    write_concern=write_concern_from_env(os.getenv("INGEST_WRITE_CONCERN", "1"),
+                                         journal=os.getenv("INGEST_JOURNAL", "0") == "1"),
+    write=buckets.write_buckets if STORAGE_LAYOUT == "bucketed" else None
+)
+INGEST_MAX_EVENTS = int(os.getenv("INGEST_MAX_EVENTS", "10000"))
+INGEST_WAIT_TIMEOUT = float(os.getenv("INGEST_WAIT_TIMEOUT", "10"))
+
+
+def ensure_indexes():
+    # Serves per-user reads in timestamp order and the (timestamp, _id) pagination cursor
+    try:
+        collection.create_index([("userId", ASCENDING)] + ACTIVITY_SORT, name="userId_timestamp")
+    except Exception as e:
+        print(f"Could not create fingerprints index: {str(e)}")
+    try:
+        explanation_cache.ensure_indexes()
+    except Exception as e:
+        print(f"Could not create explanation_cache index: {str(e)}")
+    try:
+        explanation_jobs.ensure_indexes()
+    except Exception as e:
+        print(f"Could not create explanation_jobs index: {str(e)}")
+    if STORAGE_LAYOUT == "bucketed":
+        try:
+            buckets.ensure_indexes(buckets_collection)
+        except Exception as e:
+            print(f"Could not create fingerprint_buckets indexes: {str(e)}")
+
+
+def connect_mongo():
+    """Replace the Mongo client; a pre-fork server calls this in every worker after the fork,
+    since a MongoClient must not be shared across processes."""
+    global client, db, collection, buckets_collection, user_scores
+    client = MongoClient(mongo_uri, maxPoolSize=MONGO_MAX_POOL_SIZE)
+    db = client.get_default_database()
+    collection = db["fingerprints"]
+    buckets_collection = db["fingerprint_buckets"]
+    user_scores = db["user_scores"]
+    if explanation_cache.collection is not None:
+        explanation_cache.collection = db["explanation_cache"]
+    explanation_jobs.collection = db["explanation_jobs"]
+    ingest_buffer.collection = buckets_collection if STORAGE_LAYOUT == "bucketed" else collection
+
+
+# The app listens at once and warms up on a background thread: Mongo is pinged, indexes
+# created, the model loaded and a prediction made. /ready answers 503 until all of that
+# has worked, and scoring endpoints answer 503 until the model is loaded.
+WARM_UP_RETRY = float(os.getenv("WARM_UP_RETRY", "5"))
+readiness = {"mongo": False, "model": False, "ready": False, "error": None}
+warm_up_started = threading.Event()
+
+
+def warm_up():
+    while True:
+        try:
+            client.admin.command("ping")
+            readiness["mongo"] = True
+            ensure_indexes()
+            if models.current is None:
+                models.reload()
+            models.current.predict(np.zeros((1, len(FEATURE_COLUMNS)), dtype=np.float32))
+            readiness["model"] = True
+            readiness["ready"] = True
+            readiness["error"] = None
+            if MODEL_WATCH_INTERVAL > 0:
+                models.watch(MODEL_WATCH_INTERVAL)
+            if models.state_path is not None and MODEL_STATE_INTERVAL > 0:
+                models.watch(MODEL_STATE_INTERVAL, artifact=False)
+            print("Warm-up complete")
+            return
+        except Exception as e:
+            readiness["error"] = str(e)
+            print(f"Warm-up failed, retrying in {WARM_UP_RETRY:g} seconds: {str(e)}")
+            time.sleep(WARM_UP_RETRY)
+
+
+def start_warm_up():
+    """Run warm_up on a daemon thread, once per process."""
+    if not warm_up_started.is_set():
+        warm_up_started.set()
+        threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
+
+
+def model_unavailable():
+    return jsonify({"status": "error", "message": "Model is still loading"}), 503
+
+
+def explanation_response(job_id):
+    """The explanation part of a /limit-increase response for an async job."""
+    if job_id is None:
+        # The pool is saturated: degrade to a score-only answer rather than queue without bound
+        return {"status": "unavailable"}
+    return {"status": "pending", "jobId": job_id, "url": f"/limit-increase/explanations/{job_id}"}
+
+
+# Upper bound on the records a single /limit-increase reads and scores (0 means no cap)
+MAX_SCORING_RECORDS = int(os.getenv("MAX_SCORING_RECORDS", "0"))
+
+
+def parse_scoring_window(data):
+    """Read the optional window, windowSeconds and halfLife parameters; raises ValueError."""
+    window = {}
+    for name in ("window", "windowSeconds", "halfLife"):
+        value = data.get(name)
+        if value is None:
+            continue
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or value <= 0:
+            raise ValueError(f"{name} must be a positive number")
+        window[name] = value
+    if "window" in window and not isinstance(window["window"], int):
+        raise ValueError("window must be a positive integer")
+    return window
+
+
+def fetch_scoring_records(user_id, window):
+    """Newest-first records of a user within the window, via the userId_timestamp index."""
+    query = {"userId": user_id}
+    if "windowSeconds" in window:
+        query["timestamp"] = {"$gte": int((time.time() - window["windowSeconds"]) * 1000)}
+    cursor = collection.find(query, SUMMARY_PROJECTION).sort([("timestamp", DESCENDING), ("_id", DESCENDING)])
+    limit = min(filter(None, [window.get("window"), MAX_SCORING_RECORDS]), default=0)
+    if limit:
+        cursor = cursor.limit(limit)
+    return list(cursor)
+
+
+def load_scoring_history(user_id, window):
+    """Feature matrix and records (oldest first) of the fingerprints a user's score is computed from."""
+    if STORAGE_LAYOUT == "bucketed":
+        limit = min(filter(None, [window.get("window"), MAX_SCORING_RECORDS]), default=0)
+        since = int((time.time() - window["windowSeconds"]) * 1000) if "windowSeconds" in window else None
+        with metrics.stage("mongo_find"):
+            return buckets.load_user_history(buckets_collection, user_id, limit, since, SUMMARY_FIELDS)
+
+    with metrics.stage("mongo_find"):
+        user_records = fetch_scoring_records(user_id, window)
+    user_records.reverse()
+    with metrics.stage("features"):
+        features = build_feature_matrix(user_records, capacity=len(user_records))
+    return features, user_records
+
+
+def decay_weights(timestamps, half_life):
+    """Exponential weights halving every half_life seconds back from the newest record."""
+    age_seconds = (timestamps.max() - timestamps) / 1000.0
+    return np.power(0.5, age_seconds / half_life)
 
 
 @app.route('/limit-increase', methods=['POST'])
@@ -56,99 +388,276 @@ def limit_increase():
         data = request.get_json()
         if not data or "userId" not in data:
             return jsonify({"status": "error", "message": "userId is required"}), 400
-
+        if not isinstance(data["userId"], str):
+            return jsonify({"status": "error", "message": "userId must be a string"}), 400
+
+        try:
+            window = parse_scoring_window(data)
+        except ValueError as e:
+            return jsonify({"status": "error", "message": str(e)}), 400
+
+        scorer = models.current
+        if scorer is None:
+            return model_unavailable()
+        g.model_version = scorer.version
         user_id = data["userId"]
-        user_records = list(collection.find({"userId": user_id}))
-        if not user_records:
-            return jsonify({"status": "error", "message": "No data found for this user"}), 404
-
+        # Aggregates cover the whole history, so they only answer unwindowed requests. On a hit
+        # with the explanation cached, the user's history is not read at all
+        with metrics.stage("aggregates"):
+            aggregate = None if window else aggregated_scores([user_id], scorer).get(user_id)
+        features = user_records = key = reason = None
+        if aggregate is not None:
+            avg_score, records_used = int(aggregate[0]), aggregate[1]
+            if aggregate[2] is not None:
+                key = explanation_cache.digest_key(user_id, avg_score, *aggregate[1:])
+                reason = explanation_cache.get(key)
+
+        if reason is None:
+            # Scoring on the fly and explaining both need the history
+            features, user_records = load_scoring_history(user_id, window)
+            metrics.inc("records_fetched", len(user_records))
+            if not user_records:
+                message = "No data found for this user" + (" in the requested window" if window else "")
+                return jsonify({"status": "error", "message": message}), 404
+
+        if aggregate is None:
+            records_used = len(user_records)
+            metrics.inc("rows_scored", len(features))
+            with metrics.stage("predict"):
+                if "halfLife" in window:
+                    timestamps = np.array([record["timestamp"] for record in user_records], dtype=np.float64)
+                    avg_score = int(np.average(scorer.predict(features),
+                                               weights=decay_weights(timestamps, window["halfLife"])))
+                else:
+                    avg_score = int(scorer.predict_mean(features))
+        if key is None:
+            key = explanation_cache.key(user_id, avg_score, user_records)
+            reason = explanation_cache.get(key)
+
+        if data.get("async", EXPLANATION_MODE == "async"):
+            if reason is not None:
+                explanation = {"status": "done"}
+            else:
+                explanation = explanation_response(explanation_jobs.submit(key, avg_score, features, user_records))
+            return jsonify({
+                "status": "success",
+                "data": {
+                    "score": avg_score,
+                    "recordsUsed": records_used,
+                    "modelVersion": scorer.version,
+                    "reason": reason,
+                    "explanation": explanation
+                }
+            }), 200
 
-        records_data = []
-        for record in user_records:
-            flat_record = {
-                "headless": record["headless"],
-                "cookiesEnabled": record["cookiesEnabled"],
-                "pageLoadTime": record["pageLoadTime"],
-                "event_mousemove": record["events"]["mousemove"],
-                "event_keydown": record["events"]["keydown"],
-                "event_scroll": record["events"]["scroll"],
-                "event_copy": record["events"]["copy"],
-                "ip_is_datacenter": record["ipDetails"]["is_datacenter"],
-                "screen_width": record["screen"]["width"],
-                "screen_height": record["screen"]["height"],
-                "screen_devicePixelRatio": record["screen"]["devicePixelRatio"],
-                "viewport_innerWidth": record["viewport"]["innerWidth"],
-                "viewport_innerHeight": record["viewport"]["innerHeight"],
-                "battery_level": record["battery"]["level"],
-                "battery_charging": record["battery"]["charging"],
-                "battery_chargingTime": record["battery"]["chargingTime"],
-                "hardware_cpuCores": record["hardware"]["cpuCores"],
-                "hardware_deviceMemory": record["hardware"]["deviceMemory"]
+        return jsonify({
+            "status": "success",
+            "data": {
+                "score": avg_score,
+                "recordsUsed": records_used,
+                "modelVersion": scorer.version,
+                "reason": reason or explain_and_cache(key, avg_score, features, user_records)
             }
-            records_data.append(flat_record)
+        }), 200
+
+    except Exception as e:
+        app.logger.exception("Error processing limit increase")
+        return jsonify({"status": "error", "message": f"Error processing limit increase: {str(e)}"}), 500
+
+
+@app.route('/limit-increase/explanations/<job_id>', methods=['GET'])
+def get_explanation(job_id):
+    try:
+        wants_events = request.args.get("stream") == "sse" or \
+            request.accept_mimetypes.best == "text/event-stream"
+        if not wants_events:
+            job = explanation_jobs.get(job_id)
+            if job is None:
+                return jsonify({"status": "error", "message": "Explanation job not found"}), 404
+            return jsonify({"status": "success", "data": job}), 200
+
+        if explanation_jobs.get(job_id) is None:
+            return jsonify({"status": "error", "message": "Explanation job not found"}), 404
+
+        def generate():
+            give_up = time.monotonic() + explanation_jobs.deadline
+            job = explanation_jobs.get(job_id)
+            while job is not None and job["status"] == "pending" and time.monotonic() < give_up:
+                yield ": keepalive\n\n"
+                job = explanation_jobs.wait(job_id, timeout=min(SSE_KEEPALIVE, give_up - time.monotonic()))
+            yield f"event: explanation\ndata: {json.dumps(job)}\n\n"
+
+        return Response(stream_with_context(generate()), mimetype="text/event-stream",
+                        headers={"Cache-Control": "no-cache"})
 
+    except Exception as e:
+        return jsonify({"status": "error", "message": f"Error fetching explanation: {str(e)}"}), 500
 
-        df = pd.DataFrame(records_data)
-        for col in le_dict.keys():
-            df[col] = le_dict[col].transform(df[col])
 
+@app.route('/limit-increase/batch', methods=['POST'])
+def limit_increase_batch():
+    try:
+        data = request.get_json()
+        if not data or not isinstance(data.get("userIds"), list) or not data["userIds"]:
+            return jsonify({"status": "error", "message": "userIds must be a non-empty list"}), 400
+        if not all(isinstance(user_id, str) for user_id in data["userIds"]):
+            return jsonify({"status": "error", "message": "userIds must be strings"}), 400
+
+        user_ids = list(dict.fromkeys(data["userIds"]))
+        if len(user_ids) > MAX_BATCH_USERS:
+            return jsonify({"status": "error",
+                            "message": f"At most {MAX_BATCH_USERS} userIds can be scored per batch"}), 400
+
+        explain = bool(data.get("explain", False))
+        stream = bool(data.get("stream", False))
+
+        scorer = models.current
+        if scorer is None:
+            return model_unavailable()
+        g.model_version = scorer.version
+        with metrics.stage("aggregates"):
+            aggregates = aggregated_scores(user_ids, scorer)
+        results = {
+            user_id: {"userId": user_id, "score": int(avg_score), "recordCount": int(count),
+                      "modelVersion": scorer.version}
+            for user_id, (avg_score, count, _, _) in aggregates.items()
+        }
+
+        unscored_ids = [user_id for user_id in user_ids if user_id not in results]
+        if unscored_ids:
+            with metrics.stage("mongo_find"):
+                if STORAGE_LAYOUT == "bucketed":
+                    features, keys = buckets.fetch_users_bucket_matrix(buckets_collection, unscored_ids)
+                else:
+                    features, keys = fetch_users_feature_matrix(collection, unscored_ids)
+            metrics.inc("records_fetched", len(features))
+            metrics.inc("rows_scored", len(features))
+            with metrics.stage("predict"):
+                scores = scorer.predict(features) if len(features) else np.empty(0)
+            scored_ids, avg_scores, counts = mean_by_key(scores, keys)
+            for user_id, avg_score, count in zip(scored_ids, avg_scores, counts):
+                results[user_id] = {"userId": user_id, "score": int(avg_score), "recordCount": int(count),
+                                    "modelVersion": scorer.version}
+        missing = [user_id for user_id in user_ids if user_id not in results]
+
+        def scored_results():
+            for user_id in user_ids:
+                result = results.get(user_id)
+                if result is None:
+                    continue
+                if explain:
+                    features, user_records = load_scoring_history(user_id, {})
+                    metrics.inc("records_fetched", len(user_records))
+                    result["reason"] = explain_user(user_id, result["score"], features, user_records)
+                yield result
+
+        if stream:
+            def generate():
+                for result in scored_results():
+                    yield json.dumps(result) + "\n"
+                for user_id in missing:
+                    yield json.dumps({"userId": user_id, "error": "No data found for this user"}) + "\n"
+
+            return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
 
-        scores = rf_model.predict(df[FEATURE_COLUMNS])
-        avg_score = int(np.mean(scores))
+        return jsonify({
+            "status": "success",
+            "data": list(scored_results()),
+            "missing": missing
+        }), 200
 
+    except Exception as e:
+        app.logger.exception("Error processing batch limit increase")
+        return jsonify({"status": "error", "message": f"Error processing batch limit increase: {str(e)}"}), 500
 
-        user_data_str = "\n".join([str(record) for record in user_records])
 
+def parse_ingest_events():
+    """Events from an NDJSON body, or a JSON object or array; raises ValueError."""
+    if request.mimetype in ("application/x-ndjson", "application/jsonl"):
+        return [json.loads(line) for line in request.get_data().splitlines() if line.strip()]
+    payload = json.loads(request.get_data() or b"null")
+    return payload if isinstance(payload, list) else [payload]
 
-        prompt = f"""
-        You are an expert in spotting gambling patterns, talking to your customer services colleagues. 
-        I’ve already calculated a score for this user: {avg_score} (0 means a sharp, pro bettor; 100 means a casual, everyday punter).
-        Based on this score and the user data below, explain in a simple, human-friendly way why this user got this score. 
-        Keep it short, clear, and easy to read, avoiding overly techy terms or long lists.
-        Your explanation will help a customer service rep decide next steps for this user.
 
-        Sharp bettors (closer to 0) tend to:
-        - Hide their tracks (e.g., headless browsers, no cookies)
-        - Load pages super fast (under 200ms)
-        - Use powerful gear (lots of CPU cores and memory)
-        - Barely interact (few clicks or scrolls)
-        - Stick to the same setup consistently
-        - Use datacenter IPs (like pros hiding their location)
+@app.route('/fingerprints', methods=['POST'])
+def ingest_fingerprints():
+    try:
+        with metrics.stage("ingest_parse"):
+            try:
+                events = parse_ingest_events()
+            except ValueError as e:
+                return jsonify({"status": "error", "message": f"Invalid JSON: {str(e)}"}), 400
+        if not events or events == [None]:
+            return jsonify({"status": "error", "message": "No events in the request body"}), 400
+        if len(events) > INGEST_MAX_EVENTS:
+            return jsonify({"status": "error",
+                            "message": f"At most {INGEST_MAX_EVENTS} events can be sent per request"}), 413
+
+        accepted, rejected = [], []
+        with metrics.stage("ingest_validate"):
+            for index, event in enumerate(events):
+                try:
+                    accepted.append(validate_fingerprint(event))
+                except ValueError as e:
+                    rejected.append({"index": index, "error": str(e)})
+        metrics.inc("events_rejected", len(rejected))
+        if not accepted:
+            return jsonify({"status": "error", "message": "No valid events", "rejected": rejected[:100]}), 400
+
+        sequence = ingest_buffer.add(accepted)
+        if sequence is None:
+            response = jsonify({"status": "error", "message": "Ingest buffer is full, retry shortly"})
+            response.headers["Retry-After"] = "1"
+            return response, 503
+        metrics.inc("events_ingested", len(accepted))
+
+        # ?wait=true holds the response until the events are written, trading latency for durability
+        failed = None
+        if request.args.get("wait") in ("1", "true"):
+            with metrics.stage("ingest_wait"):
+                failed = ingest_buffer.wait(sequence, INGEST_WAIT_TIMEOUT, len(accepted))
+        data = {"accepted": len(accepted), "rejected": rejected[:100], "written": failed == 0}
+        if failed:
+            return jsonify({
+                "status": "error",
+                "message": f"{failed} of {len(accepted)} events were rejected by the database",
+                "data": dict(data, failed=failed)
+            }), 500
+        return jsonify({"status": "success", "data": data}), 201 if failed == 0 else 202
 
-        Casual punters (closer to 100) tend to:
-        - Browse normally (no hiding, cookies on)
-        - Load pages at average speed (over 300ms)
-        - Use regular home computers
-        - Click and scroll a lot
-        - Change setups often
-        - Use home internet
+    except Exception as e:
+        app.logger.exception("Error ingesting fingerprints")
+        return jsonify({"status": "error", "message": f"Error ingesting fingerprints: {str(e)}"}), 500
 
-        User Data:
-        {user_data_str}
 
-        Give your answer as a reason that is no longer than 4 to 5 sentences.
-        """
+def encode_activity_cursor(record):
+    return f"{record['timestamp']}:{record['_id']}"
 
-        response = openai_client.chat.completions.create(
-            model="grok-2",
-            messages=[
-                {"role": "system", "content": "You are Grok, a gambling behavior analyst."},
-                {"role": "user", "content": prompt}
-            ],
-            max_tokens=150,
-            temperature=0.7,
-        )
 
-        return jsonify({
-            "status": "success",
-            "data": {
-                "score": avg_score,
-                "reason": response.choices[0].message.content
-            }
-        }), 200
+def decode_activity_cursor(cursor):
+    """Parse a cursor from encode_activity_cursor; raises ValueError if it is malformed."""
+    timestamp, _, object_id = str(cursor).partition(":")
+    if not ObjectId.is_valid(object_id):
+        raise ValueError(f"Invalid cursor: {cursor}")
+    return int(timestamp), ObjectId(object_id)
 
-    except Exception as e:
-        return jsonify({"status": "error", "message": f"Error processing limit increase: {str(e)}"}), 500
+
+def activity_query(user_id, after=None):
+    """Records of a user in (timestamp, _id) order, resuming after a pagination cursor."""
+    query = {"userId": user_id}
+    if after:
+        timestamp, object_id = decode_activity_cursor(after)
+        query["$or"] = [{"timestamp": {"$gt": timestamp}}, {"timestamp": timestamp, "_id": {"$gt": object_id}}]
+    return query
+
+
+def activity_projection(fields):
+    """Project the requested fields, keeping the ones the pagination cursor is built from."""
+    if not fields:
+        return None
+    projection = {field: 1 for field in fields}
+    projection.update({"_id": 1, "timestamp": 1})
+    return projection
 
 
 @app.route('/user-activity', methods=['POST'])
@@ -157,31 +666,190 @@ def get_user_activity():
         data = request.get_json()
         if not data or "userId" not in data:
             return jsonify({"status": "error", "message": "userId is required"}), 400
+        if not isinstance(data["userId"], str):
+            return jsonify({"status": "error", "message": "userId must be a string"}), 400
 
         user_id = data["userId"]
-        user_records = list(collection.find({"userId": user_id}))
+        limit = data.get("limit")
+        fields = data.get("fields")
+        if limit is not None and (not isinstance(limit, int) or limit <= 0):
+            return jsonify({"status": "error", "message": "limit must be a positive integer"}), 400
+        if fields is not None and (not isinstance(fields, list) or not all(isinstance(f, str) for f in fields)):
+            return jsonify({"status": "error", "message": "fields must be a list of field names"}), 400
+
+        try:
+            query = activity_query(user_id, data.get("after"))
+            after = decode_activity_cursor(data["after"]) if data.get("after") else None
+        except ValueError:
+            return jsonify({"status": "error", "message": "after is not a valid cursor"}), 400
+
+        if STORAGE_LAYOUT == "bucketed":
+            projection = activity_projection(fields)
+            cursor = buckets.iter_user_events(buckets_collection, user_id, after=after,
+                                              fields=list(projection) if projection else None)
+            if limit:
+                cursor = itertools.islice(cursor, limit)
+        else:
+            cursor = collection.find(query, activity_projection(fields),
+                                     batch_size=ACTIVITY_BATCH_SIZE).sort(ACTIVITY_SORT)
+            if limit:
+                cursor = cursor.limit(limit)
+        drop_timestamp = bool(fields) and "timestamp" not in fields
+
+        def clean(record):
+            record.pop('_id', None)
+            if drop_timestamp:
+                record.pop('timestamp', None)
+            return record
+
+        if data.get("stream"):
+            def generate():
+                lines = []
+                for record in cursor:
+                    lines.append(json.dumps(clean(record), default=str))
+                    if len(lines) == ACTIVITY_BATCH_SIZE:
+                        yield "\n".join(lines) + "\n"
+                        lines = []
+                if lines:
+                    yield "\n".join(lines) + "\n"
+
+            return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+        user_records = list(cursor)
 
         if not user_records:
-            return jsonify({"status": "success", "data": []}), 200
+            return jsonify({"status": "success", "data": [], "next": None}), 200
 
+        next_cursor = encode_activity_cursor(user_records[-1]) if limit and len(user_records) == limit else None
         activity_list = []
         for record in user_records:
-            record.pop('_id', None)
-            activity_list.append(record)
+            activity_list.append(clean(record))
 
         return jsonify({
             "status": "success",
-            "data": activity_list
+            "data": activity_list,
+            "next": next_cursor
         }), 200
 
     except Exception as e:
         return jsonify({"status": "error", "message": f"Error fetching user activity: {str(e)}"}), 500
 
 
+@app.route('/cache-stats', methods=['GET'])
+def cache_stats():
+    scorer = models.current
+    return jsonify({
+        "status": "success",
+        "data": {
+            "modelVersion": scorer.version if scorer else None,
+            "model": models.stats(),
+            "predictions": scorer.cache.stats() if scorer and scorer.cache else None,
+            "explanations": explanation_cache.stats(),
+            "explanationJobs": explanation_jobs.stats(),
+            "ingest": ingest_buffer.stats()
+        }
+    }), 200
+
+
+@app.before_request
+def start_request_timer():
+    if metrics.enabled:
+        g.request_start = time.perf_counter()
+
+
+@app.after_request
+def record_request_metrics(response):
+    if metrics.enabled and "request_start" in g:
+        endpoint = request.url_rule.rule if request.url_rule is not None else "unmatched"
+        metrics.observe_request(endpoint, response.status_code, time.perf_counter() - g.request_start)
+        if metrics.server_timing:
+            server_timing = metrics.server_timing_header()
+            if server_timing:
+                response.headers["Server-Timing"] = server_timing
+    return response
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    if not metrics.enabled:
+        return jsonify({"status": "error", "message": "Metrics are disabled"}), 404
+    if models.current is not None:
+        metrics.set_model_version(models.current.version)
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+@app.after_request
+def tag_model_version(response):
+    """Tag scoring responses with the model version that produced them."""
+    model_version = g.get("model_version")
+    if model_version is not None:
+        response.headers["X-Model-Version"] = model_version
+    return response
+
+
+# Admin endpoints are off unless ADMIN_TOKEN is set; callers send it in X-Admin-Token
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+
+
+def admin_denied():
+    if not ADMIN_TOKEN:
+        return jsonify({"status": "error", "message": "Admin endpoints are disabled"}), 404
+    if request.headers.get("X-Admin-Token") != ADMIN_TOKEN:
+        return jsonify({"status": "error", "message": "Invalid admin token"}), 403
+    return None
+
+
+@app.route('/admin/model', methods=['GET'])
+def admin_model():
+    denied = admin_denied()
+    if denied:
+        return denied
+    return jsonify({"status": "success", "data": models.stats()}), 200
+
+
+@app.route('/admin/model/reload', methods=['POST'])
+def admin_model_reload():
+    denied = admin_denied()
+    if denied:
+        return denied
+    data = request.get_json(silent=True) or {}
+    try:
+        result = models.reload(force=bool(data.get("force", False)))
+    except Exception as e:
+        return jsonify({"status": "error", "message": f"Error reloading model: {str(e)}"}), 500
+    code = 200 if result["status"] != "failed" else 422
+    return jsonify({"status": "success" if code == 200 else "error", "data": result}), code
+
+
+@app.route('/admin/model/rollback', methods=['POST'])
+def admin_model_rollback():
+    denied = admin_denied()
+    if denied:
+        return denied
+    result = models.rollback()
+    code = 200 if result["status"] != "failed" else 409
+    return jsonify({"status": "success" if code == 200 else "error", "data": result}), code
+
+
 @app.route('/health', methods=['GET'])
 def health_check():
     return jsonify({"status": "healthy"}), 200
 
 
+@app.route('/ready', methods=['GET'])
+def ready_check():
+    """Readiness: Mongo answered a ping and the model has made a prediction."""
+    scorer = models.current
+    body = dict(readiness, modelVersion=scorer.version if scorer else None)
+    if not readiness["ready"]:
+        return jsonify(dict(body, status="starting")), 503
+    return jsonify(dict(body, status="ready")), 200
+
+
+# gunicorn.conf.py turns this off and warms up each worker after the fork instead
+if os.getenv("WARM_UP_ON_IMPORT", "1") == "1":
+    start_warm_up()
+
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=8080, debug=False)
@@ -0,0 +1,289 @@
+import argparse
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import warnings
+import numpy as np
+import pandas as pd
+from sklearn.ensemble import RandomForestRegressor
+from sklearn.preprocessing import LabelEncoder
+from cache import PredictionCache
+from console import personas, generate_user_activity
+from features import FEATURE_COLUMNS, BOOLEAN_COLUMNS, build_feature_matrix
+from forest import FlatForest
+from model import save_model
+import seed
+
+
+warnings.filterwarnings("ignore", message="X does not have valid feature names")
+
+
+def generate_records(num_records, seed=42):
+    """Generate fingerprint documents across all personas."""
+    random.seed(seed)
+    persona_names = list(personas.keys())
+    return [generate_user_activity(persona_names[i % len(persona_names)]) for i in range(num_records)]
+
+
+def train_benchmark_model(seed=42, n_estimators=100):
+    """Train a small forest on synthetic records shaped like the pickled one (fitted on a DataFrame)."""
+    records = generate_records(5000, seed=seed)
+    X = pd.DataFrame(build_feature_matrix(records), columns=FEATURE_COLUMNS)
+    y = np.random.default_rng(seed).integers(0, 2, len(records)) * 100
+    model = RandomForestRegressor(n_estimators=n_estimators, max_depth=10, random_state=seed, n_jobs=-1)
+    model.fit(X, y)
+    return model
+
+
+def legacy_feature_frame(user_records):
+    """The original /limit-increase path: per-record dicts, a DataFrame and LabelEncoders."""
+    le_dict = {}
+    for col in BOOLEAN_COLUMNS:
+        le_dict[col] = LabelEncoder()
+        le_dict[col].fit([0, 1])
+
+    records_data = []
+    for record in user_records:
+        flat_record = {
+            "headless": record["headless"],
+            "cookiesEnabled": record["cookiesEnabled"],
+            "pageLoadTime": record["pageLoadTime"],
+            "event_mousemove": record["events"]["mousemove"],
+            "event_keydown": record["events"]["keydown"],
+            "event_scroll": record["events"]["scroll"],
+            "event_copy": record["events"]["copy"],
+            "ip_is_datacenter": record["ipDetails"]["is_datacenter"],
+            "screen_width": record["screen"]["width"],
+            "screen_height": record["screen"]["height"],
+            "screen_devicePixelRatio": record["screen"]["devicePixelRatio"],
+            "viewport_innerWidth": record["viewport"]["innerWidth"],
+            "viewport_innerHeight": record["viewport"]["innerHeight"],
+            "battery_level": record["battery"]["level"],
+            "battery_charging": record["battery"]["charging"],
+            "battery_chargingTime": record["battery"]["chargingTime"],
+            "hardware_cpuCores": record["hardware"]["cpuCores"],
+            "hardware_deviceMemory": record["hardware"]["deviceMemory"]
+        }
+        records_data.append(flat_record)
+
+    df = pd.DataFrame(records_data)
+    for col in le_dict.keys():
+        df[col] = le_dict[col].transform(df[col])
+    return df[FEATURE_COLUMNS]
+
+
+def time_call(func, *args, repeat=5):
+    """Return the best wall time over a few runs along with the last result."""
+    best = float("inf")
+    result = None
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        result = func(*args)
+        best = min(best, time.perf_counter() - start_time)
+    return best, result
+
+
+def benchmark_feature_extraction(sizes=(100, 10000, 50000)):
+    """Compare the legacy DataFrame/LabelEncoder path with the float32 matrix builder."""
+    model = train_benchmark_model()
+    print("Feature extraction (best of 5):")
+    for size in sizes:
+        records = generate_records(size)
+        legacy_time, legacy_frame = time_call(legacy_feature_frame, records)
+        matrix_time, matrix = time_call(build_feature_matrix, records)
+        same_scores = np.array_equal(model.predict(legacy_frame), model.predict(matrix))
+        print(f"{size:>8} records: legacy {legacy_time * 1000:8.1f} ms, matrix {matrix_time * 1000:8.1f} ms "
+              f"({legacy_time / matrix_time:.1f}x), identical scores: {same_scores}")
+
+
+def benchmark_inference(sizes=(1, 10, 1000, 100000)):
+    """Compare sklearn's predict with the flat-array forest engine."""
+    model = train_benchmark_model()
+    flat_forest = FlatForest.from_sklearn(model)
+    base = build_feature_matrix(generate_records(10000, seed=7))
+    print("Inference (best of 5):")
+    for size in sizes:
+        X = np.resize(base, (size, len(FEATURE_COLUMNS)))
+        sklearn_time, sklearn_scores = time_call(model.predict, X)
+        flat_time, flat_scores = time_call(flat_forest.predict, X)
+        print(f"{size:>8} rows: sklearn {sklearn_time * 1000:8.2f} ms, flat {flat_time * 1000:8.2f} ms "
+              f"({sklearn_time / flat_time:.1f}x), bit-identical: {np.array_equal(sklearn_scores, flat_scores)}")
+
+
+def benchmark_prediction_cache(sizes=(1000, 50000)):
+    """Scoring with no PredictionCache, a cold one (every persona row is distinct) and a warm one."""
+    model = train_benchmark_model()
+    flat_forest = FlatForest.from_sklearn(model)
+    print("Prediction cache (best of 5):")
+    for size in sizes:
+        X = build_feature_matrix(generate_records(size, seed=7))
+        for engine, predict in (("sklearn", model.predict), ("flat", flat_forest.predict)):
+            plain_time, _ = time_call(predict, X)
+            cold_time, _ = time_call(lambda: PredictionCache(size).predict(X, predict, "benchmark"))
+            warm_cache = PredictionCache(size)
+            warm_cache.predict(X, predict, "benchmark")
+            warm_time, _ = time_call(warm_cache.predict, X, predict, "benchmark")
+            print(f"{size:>8} rows, {engine:<7}: uncached {plain_time * 1000:8.2f} ms, "
+                  f"cold {cold_time * 1000:8.2f} ms, warm {warm_time * 1000:8.2f} ms")
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def benchmark_seed(sizes=(500000,)):
+    """Rows/sec of the columnar CSV generator, against the per-record generator on a sample."""
+    legacy_rows = 50000
+    start_time = time.perf_counter()
+    for _ in range(legacy_rows):
+        seed.generate_random_user_activity()
+    legacy_rate = legacy_rows / (time.perf_counter() - start_time)
+    print(f"Per-record generator: {legacy_rate:,.0f} rows/sec (records only, before any CSV writing)")
+
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            output_file = os.path.join(tmp_dir, "dataset.csv")
+            start_time = time.perf_counter()
+            seed.generate_csv_dataset(num_records=size, output_file=output_file, seed=42)
+            elapsed = time.perf_counter() - start_time
+            file_mb = os.path.getsize(output_file) / 1024 / 1024
+        print(f"Columnar generator, {size:,} rows: {size / elapsed:,.0f} rows/sec, {elapsed:.1f} s, "
+              f"{file_mb:,.0f} MB written, peak RSS {peak_rss_mb():,.0f} MB")
+
+
+LOAD_SCRIPTS = {
+    "csv, original preprocessing": """
+df = pd.read_csv(PATH)
+for col in BOOLEAN_COLUMNS:
+    df[col] = LabelEncoder().fit_transform(df[col])
+X = df[FEATURE_COLUMNS]
+y = df["target"].apply(lambda x: 0 if x == 1 else 100)
+""",
+    "csv, typed columns": "X, target = model.load_feature_matrix(PATH, use_cache=False)",
+    "npy columns": "X, target = model.load_feature_matrix(PATH, use_cache=False)",
+    "feature cache (mmap)": "X, target = model.load_feature_matrix(PATH); X.sum(); target.sum()",
+}
+
+
+def measure_load(name, path):
+    """Time a loading script in a fresh interpreter; returns (seconds, peak RSS MB, RSS MB after imports)."""
+    script = f"""
+import time, warnings
+warnings.filterwarnings("ignore")
+def peak_rss_mb():
+    # VmHWM starts afresh at exec, unlike ru_maxrss which a child inherits from its parent
+    with open("/proc/self/status") as status:
+        return next(int(line.split()[1]) for line in status if line.startswith("VmHWM")) / 1024
+import pandas as pd
+from sklearn.preprocessing import LabelEncoder
+from features import FEATURE_COLUMNS, BOOLEAN_COLUMNS
+import model
+PATH = {path!r}
+baseline = peak_rss_mb()
+start_time = time.perf_counter()
+{LOAD_SCRIPTS[name]}
+print(time.perf_counter() - start_time, peak_rss_mb(), baseline)
+"""
+    output = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, check=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+    seconds, rss, baseline = output.strip().splitlines()[-1].split()
+    return float(seconds), float(rss), float(baseline)
+
+
+def benchmark_loading(sizes=(500000,)):
+    """Load time and peak RSS of the training data: CSV against per-column .npy and the feature cache."""
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            csv_path = os.path.join(tmp_dir, "dataset.csv")
+            npy_path = os.path.join(tmp_dir, "dataset")
+            seed.generate_csv_dataset(num_records=size, output_file=csv_path, seed=42, verbose=False)
+            seed.generate_npy_dataset(num_records=size, output_dir=npy_path, seed=42)
+            measure_load("npy columns", npy_path)  # Warm the page cache for every format alike
+
+            print(f"Loading {size:,} rows (excluding interpreter start-up and imports):")
+            for name, path in [("csv, original preprocessing", csv_path), ("csv, typed columns", csv_path),
+                               ("npy columns", npy_path), ("feature cache (mmap)", npy_path),
+                               ("feature cache (mmap)", npy_path)]:
+                seconds, rss, baseline = measure_load(name, path)
+                print(f"  {name:<28} {seconds:7.2f} s, peak RSS {rss:7.0f} MB ({rss - baseline:+.0f} MB over imports)")
+
+
+MODEL_LOAD_SCRIPTS = {
+    "pickle": "scorer = Scorer(*load_model(PATH + '.pkl'))",
+    "flat (mmap)": "scorer = Scorer(None, None, flat_forest=FlatForest.load(PATH + '.flat'))",
+}
+
+
+def measure_model_load(name, path):
+    """Time loading the model and scoring one row in a fresh interpreter.
+
+    Returns (seconds, private MB added, file-backed MB added). Private memory is each
+    worker's own; file-backed pages of a mapped artifact are shared through the page cache.
+    """
+    script = f"""
+import time, warnings
+warnings.filterwarnings("ignore")
+import numpy as np
+from forest import FlatForest
+from scoring import Scorer, load_model
+from features import FEATURE_COLUMNS
+def rss_mb():
+    with open("/proc/self/status") as status:
+        fields = dict(line.split(":", 1) for line in status)
+    return int(fields["RssAnon"].split()[0]) / 1024, int(fields["RssFile"].split()[0]) / 1024
+PATH = {path!r}
+private_before, shared_before = rss_mb()
+start_time = time.perf_counter()
+{MODEL_LOAD_SCRIPTS[name]}
+scorer.predict(np.zeros((1, len(FEATURE_COLUMNS)), dtype=np.float32))
+private, shared = rss_mb()
+print(time.perf_counter() - start_time, private - private_before, shared - shared_before)
+"""
+    output = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, check=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+    seconds, private, shared = output.strip().splitlines()[-1].split()
+    return float(seconds), float(private), float(shared)
+
+
+def benchmark_model_loading(sizes=(100,)):
+    """Start-up time and memory of a worker loading the pickled model against the mapped flat artifact."""
+    for size in sizes:
+        model = train_benchmark_model(n_estimators=size)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "model")
+            save_model(model, path + ".pkl", flat_path=path + ".flat")
+            measure_model_load("flat (mmap)", path)  # Warm the page cache for both artifacts
+            measure_model_load("pickle", path)
+
+            print(f"Loading a {size}-tree model and scoring one row (excluding imports):")
+            for name in MODEL_LOAD_SCRIPTS:
+                seconds, private, shared = measure_model_load(name, path)
+                print(f"  {name:<12} {seconds * 1000:7.1f} ms, private {private:6.1f} MB, shared {shared:6.1f} MB")
+
+
+BENCHMARKS = {
+    "features": benchmark_feature_extraction,
+    "inference": benchmark_inference,
+    "prediction-cache": benchmark_prediction_cache,
+    "seed": benchmark_seed,
+    "loading": benchmark_loading,
+    "model-loading": benchmark_model_loading,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run ppric-api micro-benchmarks.")
+    parser.add_argument("benchmarks", nargs="*", choices=list(BENCHMARKS), default=list(BENCHMARKS))
+    parser.add_argument("--sizes", type=int, nargs="+", help="Override the benchmark's default sizes, "
+                                                               "e.g. --sizes 500000 50000000 for seed")
+    args = parser.parse_args()
+
+    for name in args.benchmarks:
+        if args.sizes:
+            BENCHMARKS[name](sizes=args.sizes)
+        else:
+            BENCHMARKS[name]()
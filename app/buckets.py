@@ -0,0 +1,319 @@
+import argparse
+import os
+import time
+from itertools import groupby
+import numpy as np
+from bson import ObjectId
+from pymongo import MongoClient, ASCENDING, DESCENDING, WriteConcern
+from pymongo.errors import DuplicateKeyError
+from features import FEATURE_COLUMNS, FEATURE_FIELDS
+from ingest import WriteRejected
+
+
+# One bucket holds up to BUCKET_MAX_EVENTS fingerprints of one user from one time slot.
+# Every field is stored as an array across the bucket's events: feature values as plain
+# arrays under "features", and the repeated strings dictionary-encoded under "strings",
+# where each event stores an index into the bucket's list of distinct values.
+#
+# score_worker.py, refresh_model.py and console.py still read and write the fingerprints
+# collection, so the API does not use the user_scores aggregates with this layout.
+BUCKET_SECONDS = int(os.getenv("BUCKET_SECONDS", "3600"))
+BUCKET_MAX_EVENTS = int(os.getenv("BUCKET_MAX_EVENTS", "1000"))
+STRING_FIELDS = ["fingerprint", "timezone", "language", "ipDetails.country", "ipDetails.asn", "screen.orientation"]
+MAX_APPEND_CONFLICTS = 20
+
+
+def lookup(document, field):
+    for key in field.split("."):
+        document = document.get(key) if isinstance(document, dict) else None
+    return document
+
+
+def string_key(field):
+    # Field names can't contain dots inside a document
+    return field.replace(".", "_")
+
+
+def assign(document, field, value):
+    *parents, last = field.split(".")
+    for key in parents:
+        document = document.setdefault(key, {})
+    document[last] = value
+
+
+def ensure_indexes(buckets_collection):
+    """Serves per-user reads in time order, and keeps one bucket per (user, slot, sequence)."""
+    buckets_collection.create_index([("userId", ASCENDING), ("slot", ASCENDING), ("seq", ASCENDING)], unique=True)
+    buckets_collection.create_index([("userId", ASCENDING), ("end", ASCENDING)])
+
+
+def slot_of(timestamp):
+    return timestamp // (BUCKET_SECONDS * 1000)
+
+
+def encode_events(events, dictionaries=None):
+    """Column arrays for a list of fingerprints, extending the given string dictionaries.
+
+    Returns the per-field arrays and, per string field, the values new to its dictionary.
+    """
+    dictionaries = dictionaries or {}
+    columns = {
+        "ids": [event["_id"] for event in events],
+        "timestamp": [event["timestamp"] for event in events],
+        "serverTimestamp": [event.get("serverTimestamp") for event in events],
+        "features": {column: [lookup(event, field) for event in events]
+                     for column, field in zip(FEATURE_COLUMNS, FEATURE_FIELDS)},
+        "codes": {}
+    }
+    new_values = {}
+    for field in STRING_FIELDS:
+        values = list(dictionaries.get(field, []))
+        index = {value: code for code, value in enumerate(values)}
+        added = []
+        codes = []
+        for event in events:
+            value = lookup(event, field)
+            code = index.get(value)
+            if code is None:
+                code = index[value] = len(values) + len(added)
+                added.append(value)
+            codes.append(code)
+        columns["codes"][field] = codes
+        new_values[field] = added
+    return columns, new_values
+
+
+def new_bucket(user_id, slot, seq, events):
+    columns, new_values = encode_events(events)
+    timestamps = columns["timestamp"]
+    return {
+        "userId": user_id, "slot": slot, "seq": seq, "count": len(events),
+        "start": min(timestamps), "end": max(timestamps),
+        "ids": columns["ids"], "timestamp": timestamps, "serverTimestamp": columns["serverTimestamp"],
+        "features": columns["features"],
+        "strings": {string_key(field): {"values": new_values[field], "codes": columns["codes"][field]}
+                    for field in STRING_FIELDS}
+    }
+
+
+def append_events(buckets_collection, user_id, slot, events):
+    """Append one user's events from one slot to its open bucket, opening new buckets as they fill.
+
+    Appends are guarded on the bucket's count, so concurrent writers never interleave
+    their dictionary codes; a writer that loses the race re-reads the bucket and retries.
+    Events are removed from the list as they are written. The guards need acknowledged
+    writes (matched counts and duplicate key errors), which write_buckets ensures.
+    """
+    conflicts = 0
+    while events:
+        if conflicts > MAX_APPEND_CONFLICTS:
+            raise WriteRejected(f"Could not append {len(events)} events for user {user_id} after repeated conflicts")
+        bucket = buckets_collection.find_one({"userId": user_id, "slot": slot},
+                                             {"seq": 1, "count": 1, "strings": 1}, sort=[("seq", DESCENDING)])
+        if bucket is None or bucket["count"] >= BUCKET_MAX_EVENTS:
+            seq = bucket["seq"] + 1 if bucket is not None else 0
+            try:
+                buckets_collection.insert_one(new_bucket(user_id, slot, seq, events[:BUCKET_MAX_EVENTS]))
+            except DuplicateKeyError:
+                conflicts += 1
+                continue
+            del events[:BUCKET_MAX_EVENTS]
+            continue
+
+        take = events[:BUCKET_MAX_EVENTS - bucket["count"]]
+        dictionaries = {field: bucket["strings"][string_key(field)]["values"] for field in STRING_FIELDS}
+        columns, new_values = encode_events(take, dictionaries)
+        push = {"ids": {"$each": columns["ids"]}, "timestamp": {"$each": columns["timestamp"]},
+                "serverTimestamp": {"$each": columns["serverTimestamp"]}}
+        for column, values in columns["features"].items():
+            push[f"features.{column}"] = {"$each": values}
+        for field in STRING_FIELDS:
+            push[f"strings.{string_key(field)}.codes"] = {"$each": columns["codes"][field]}
+            if new_values[field]:
+                push[f"strings.{string_key(field)}.values"] = {"$each": new_values[field]}
+        result = buckets_collection.update_one(
+            {"_id": bucket["_id"], "count": bucket["count"]},
+            {"$push": push, "$inc": {"count": len(take)},
+             "$min": {"start": min(columns["timestamp"])}, "$max": {"end": max(columns["timestamp"])}}
+        )
+        if result.matched_count:
+            del events[:len(take)]
+        else:
+            conflicts += 1
+
+
+def write_buckets(buckets_collection, events):
+    """Write a batch of fingerprints into their users' buckets.
+
+    Events are removed from the list as they are written, so after an error a retry
+    with the same list writes only the rest. A group that keeps conflicting with other
+    writers is left in the list, and WriteRejected is raised once the other groups are
+    written. Unacknowledged write concerns are raised to w=1 for the append guards.
+    """
+    if not buckets_collection.write_concern.acknowledged:
+        buckets_collection = buckets_collection.with_options(write_concern=WriteConcern(w=1))
+    for event in events:
+        event.setdefault("_id", ObjectId())
+    written = set()
+    rejected = []
+    try:
+        ordered = sorted(events, key=lambda event: (event["userId"], slot_of(event["timestamp"])))
+        for (user_id, slot), group in groupby(ordered, key=lambda event: (event["userId"], slot_of(event["timestamp"]))):
+            group = list(group)
+            remaining = list(group)
+            try:
+                append_events(buckets_collection, user_id, slot, remaining)
+            except WriteRejected as e:
+                rejected.append(str(e))
+            finally:
+                unwritten = {event["_id"] for event in remaining}
+                written.update(event["_id"] for event in group if event["_id"] not in unwritten)
+    finally:
+        events[:] = [event for event in events if event["_id"] not in written]
+    if rejected:
+        raise WriteRejected("; ".join(rejected))
+
+
+def unpack_features(buckets):
+    """Feature matrix of every event in the buckets, with the userId and timestamp of each row."""
+    buckets = list(buckets)
+    count = sum(bucket["count"] for bucket in buckets)
+    matrix = np.empty((count, len(FEATURE_COLUMNS)), dtype=np.float32)
+    timestamps = np.empty(count, dtype=np.int64)
+    user_ids = []
+    row = 0
+    for bucket in buckets:
+        rows = slice(row, row + bucket["count"])
+        for index, column in enumerate(FEATURE_COLUMNS):
+            matrix[rows, index] = bucket["features"][column]
+        timestamps[rows] = bucket["timestamp"]
+        user_ids.extend([bucket["userId"]] * bucket["count"])
+        row += bucket["count"]
+    return matrix, user_ids, timestamps
+
+
+def unpack_events(bucket, fields=None):
+    """Rebuild the fingerprint documents of a bucket, optionally only the given fields."""
+    wanted = None if fields is None else set(fields)
+    feature_columns = [(column, field) for column, field in zip(FEATURE_COLUMNS, FEATURE_FIELDS)
+                       if wanted is None or field in wanted or field.split(".")[0] in wanted]
+    string_fields = [field for field in STRING_FIELDS
+                     if wanted is None or field in wanted or field.split(".")[0] in wanted]
+    events = []
+    for index in range(bucket["count"]):
+        event = {"_id": bucket["ids"][index], "userId": bucket["userId"], "timestamp": bucket["timestamp"][index]}
+        for column, field in feature_columns:
+            assign(event, field, bucket["features"][column][index])
+        for field in string_fields:
+            strings = bucket["strings"][string_key(field)]
+            value = strings["values"][strings["codes"][index]]
+            if value is not None:
+                assign(event, field, value)
+        if wanted is None or "serverTimestamp" in wanted:
+            event["serverTimestamp"] = bucket["serverTimestamp"][index]
+        if wanted is not None and "userId" not in wanted:
+            del event["userId"]
+        events.append(event)
+    return events
+
+
+def iter_user_events(buckets_collection, user_id, after=None, fields=None, newest_first=False, since=None):
+    """A user's fingerprints in (timestamp, _id) order, read bucket by bucket.
+
+    after is a (timestamp, _id) position to resume past, since a minimum timestamp.
+    Buckets of the same slot may overlap in time, so each slot is sorted as a whole.
+    """
+    query = {"userId": user_id}
+    low = max(filter(None, [after[0] if after else None, since]), default=None)
+    if low is not None:
+        query["end"] = {"$gte": low}
+    order = DESCENDING if newest_first else ASCENDING
+    cursor = buckets_collection.find(query).sort([("slot", order), ("seq", order)])
+    for _, slot_buckets in groupby(cursor, key=lambda bucket: bucket["slot"]):
+        events = [event for bucket in slot_buckets for event in unpack_events(bucket, fields)]
+        events.sort(key=lambda event: (event["timestamp"], event["_id"]), reverse=newest_first)
+        for event in events:
+            if since is not None and event["timestamp"] < since:
+                continue
+            if after is not None and (event["timestamp"], event["_id"]) <= after:
+                continue
+            yield event
+
+
+def load_user_history(buckets_collection, user_id, limit=0, since=None, fields=("timestamp",)):
+    """A user's newest limit events (all if 0) from since on, oldest first.
+
+    Returns the feature matrix, unpacked straight from the bucket arrays, and the events
+    rebuilt with only the given fields. Whole slots are read, as buckets within a slot
+    may overlap in time.
+    """
+    query = {"userId": user_id}
+    if since is not None:
+        query["end"] = {"$gte": since}
+    buckets = []
+    count = 0
+    for bucket in buckets_collection.find(query).sort([("slot", DESCENDING), ("seq", DESCENDING)]):
+        if limit and count >= limit and bucket["slot"] != buckets[-1]["slot"]:
+            break
+        buckets.append(bucket)
+        count += bucket["count"]
+
+    matrix, _, timestamps = unpack_features(buckets)
+    events = [event for bucket in buckets for event in unpack_events(bucket, fields)]
+    order = np.argsort(timestamps, kind="stable")
+    if since is not None:
+        order = order[timestamps[order] >= since]
+    if limit:
+        order = order[-limit:]
+    return matrix[order], [events[index] for index in order]
+
+
+def fetch_users_bucket_matrix(buckets_collection, user_ids):
+    """Bucketed counterpart of features.fetch_users_feature_matrix: rows keyed by userId."""
+    projection = {"userId": 1, "count": 1, "timestamp": 1, "features": 1}
+    matrix, keys, _ = unpack_features(buckets_collection.find({"userId": {"$in": list(user_ids)}}, projection))
+    return matrix, keys
+
+
+def migrate(collection, buckets_collection, batch_size=10000, query=None):
+    """Copy the fingerprints matching query (all by default) into buckets, user by user; returns the bucket count."""
+    ensure_indexes(buckets_collection)
+    cursor = collection.find(query or {}, batch_size=batch_size).sort([("userId", ASCENDING), ("timestamp", ASCENDING)])
+    batch = []
+    bucket_count = 0
+    for (user_id, slot), group in groupby(cursor, key=lambda event: (event["userId"], slot_of(event["timestamp"]))):
+        group = list(group)
+        for start in range(0, len(group), BUCKET_MAX_EVENTS):
+            batch.append(new_bucket(user_id, slot, start // BUCKET_MAX_EVENTS, group[start:start + BUCKET_MAX_EVENTS]))
+        if len(batch) >= 100:
+            buckets_collection.insert_many(batch, ordered=False)
+            bucket_count += len(batch)
+            batch = []
+    if batch:
+        buckets_collection.insert_many(batch, ordered=False)
+        bucket_count += len(batch)
+    return bucket_count
+
+
+def collection_size(db, name):
+    stats = db.command("collStats", name)
+    return stats["count"], stats["size"], stats["totalIndexSize"]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert fingerprints into the bucketed layout (STORAGE_LAYOUT=bucketed).")
+    parser.add_argument("--replace", action="store_true", help="Drop existing buckets before migrating")
+    args = parser.parse_args()
+
+    db = MongoClient(os.getenv("MONGO_URI")).get_default_database()
+    if db["fingerprint_buckets"].estimated_document_count() and not args.replace:
+        raise SystemExit("fingerprint_buckets is not empty; rerun with --replace to rebuild it")
+    db["fingerprint_buckets"].drop()
+
+    start_time = time.time()
+    buckets = migrate(db["fingerprints"], db["fingerprint_buckets"])
+    print(f"Wrote {buckets} buckets in {time.time() - start_time:.1f} seconds")
+    for name in ["fingerprints", "fingerprint_buckets"]:
+        count, size, index_size = collection_size(db, name)
+        print(f"  {name:<20} {count:>10,} documents, {size / 1024 / 1024:8.1f} MB data, "
+              f"{index_size / 1024 / 1024:6.1f} MB indexes")
@@ -0,0 +1,205 @@
+import threading
+import time
+from datetime import datetime, timedelta
+from collections import OrderedDict
+import numpy as np
+
+
+class LRUCache:
+    """A thread-safe, size-bounded least-recently-used cache with hit/miss counters.
+
+    With a ttl, entries also expire that many seconds after they were stored.
+    """
+
+    def __init__(self, maxsize, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and (entry[0] is None or entry[0] > time.monotonic()):
+                self._data.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def get_many(self, keys):
+        """Look up many keys under one lock acquisition; returns a value or None per key."""
+        now = time.monotonic()
+        values = []
+        with self._lock:
+            for key in keys:
+                entry = self._data.get(key)
+                if entry is not None and (entry[0] is None or entry[0] > now):
+                    self._data.move_to_end(key)
+                    values.append(entry[1])
+                    continue
+                if entry is not None:
+                    del self._data[key]
+                values.append(None)
+            hits = sum(value is not None for value in values)
+            self.hits += hits
+            self.misses += len(values) - hits
+        return values
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            self._data[key] = (expires, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def put_many(self, items):
+        """Store many (key, value) pairs under one lock acquisition."""
+        if self.maxsize <= 0:
+            return
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            for key, value in items:
+                self._data[key] = (expires, value)
+                self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hitRatio": self.hits / lookups if lookups else 0.0
+        }
+
+
+class PredictionCache:
+    """Memoizes per-row model scores, keyed by model version and the encoded feature vector.
+
+    Rows are first deduplicated within the request, so each distinct feature vector is
+    looked up (and, on a miss, predicted) once. The raw float32 bytes of the row are the
+    key; the dict hashes them, and keeping the bytes rules out hash collisions. Lookups
+    and stores take the LRU lock once per request rather than once per row, but a cold
+    request of all-distinct rows still pays for building the keys on top of predicting.
+    """
+
+    def __init__(self, maxsize):
+        self.cache = LRUCache(maxsize)
+        self.rows_predicted = 0
+
+    def predict(self, features, predict, model_version):
+        """Return a score for every row of features, calling predict only for unseen rows."""
+        unique_rows, inverse, _ = unique_rows_of(features)
+        return self._predict_unique(unique_rows, predict, model_version)[inverse]
+
+    def predict_mean(self, features, predict, model_version):
+        """Mean score over all rows, as a count-weighted mean of the distinct rows' scores."""
+        unique_rows, _, counts = unique_rows_of(features)
+        unique_scores = self._predict_unique(unique_rows, predict, model_version)
+        return float(np.dot(unique_scores, counts) / counts.sum())
+
+    def _predict_unique(self, unique_rows, predict, model_version):
+        keys = [(model_version, row.tobytes()) for row in unique_rows]
+        cached = self.cache.get_many(keys)
+        missing = [index for index, score in enumerate(cached) if score is None]
+        if not missing:
+            return np.array(cached, dtype=np.float64)
+
+        scores = np.array([np.nan if score is None else score for score in cached], dtype=np.float64)
+        scores[missing] = predict(unique_rows[missing])
+        self.rows_predicted += len(missing)
+        self.cache.put_many((keys[index], scores[index]) for index in missing)
+        return scores
+
+    def stats(self):
+        return dict(self.cache.stats(), rowsPredicted=self.rows_predicted)
+
+
+def unique_rows_of(features):
+    """Distinct rows of a matrix with the inverse index and counts, like np.unique(axis=0).
+
+    Each row is viewed as one opaque byte string, which sorts far faster than
+    np.unique's row-wise lexicographic comparison.
+    """
+    features = np.ascontiguousarray(features)
+    row_bytes = features.view(np.dtype((np.void, features.dtype.itemsize * features.shape[1]))).ravel()
+    unique, inverse, counts = np.unique(row_bytes, return_inverse=True, return_counts=True)
+    return unique.view(features.dtype).reshape(len(unique), features.shape[1]), inverse.ravel(), counts
+
+
+class ExplanationCache:
+    """Caches LLM explanations by userId, score bucket and a digest of the records explained.
+
+    The digest is the record count with the oldest and newest timestamps, so any new
+    fingerprint (or a different window) gives a new key. Entries live in a local TTL/LRU
+    cache; with a collection they are also shared through Mongo, where a TTL index drops
+    them, so they survive restarts and are seen by every API replica.
+    """
+
+    def __init__(self, maxsize, ttl, score_bucket=5, collection=None):
+        self.cache = LRUCache(maxsize, ttl=ttl)
+        self.ttl = ttl
+        self.score_bucket = score_bucket
+        self.collection = collection
+        self.shared_hits = 0
+        self.saved_seconds = 0.0
+
+    def ensure_indexes(self):
+        if self.collection is not None:
+            self.collection.create_index("createdAt", expireAfterSeconds=self.ttl)
+
+    def key(self, user_id, score, user_records):
+        timestamps = [record.get("timestamp", 0) for record in user_records]
+        return self.digest_key(user_id, score, len(user_records), min(timestamps), max(timestamps))
+
+    def digest_key(self, user_id, score, count, first_timestamp, last_timestamp):
+        """The key for records summarized by count and timestamps, as the user_scores aggregates are."""
+        return f"{user_id}:{int(score) // self.score_bucket}:{count}:{first_timestamp}:{last_timestamp}"
+
+    def get(self, key):
+        """The cached explanation, or None."""
+        entry = self.cache.get(key)
+        if entry is None and self.collection is not None:
+            doc = self.collection.find_one({
+                "_id": key, "createdAt": {"$gt": datetime.utcnow() - timedelta(seconds=self.ttl)}
+            })
+            if doc is not None:
+                entry = (doc["reason"], doc["latency"])
+                self.cache.put(key, entry)
+                self.shared_hits += 1
+        if entry is None:
+            return None
+        self.saved_seconds += entry[1]
+        return entry[0]
+
+    def put(self, key, reason, latency):
+        """Store an explanation along with how long the LLM took to produce it."""
+        self.cache.put(key, (reason, latency))
+        if self.collection is not None:
+            self.collection.replace_one({"_id": key}, {
+                "reason": reason, "latency": latency, "createdAt": datetime.utcnow()
+            }, upsert=True)
+
+    def stats(self):
+        stats = self.cache.stats()
+        hits = stats["hits"] + self.shared_hits
+        lookups = stats["hits"] + stats["misses"]
+        return dict(stats, hits=hits, misses=lookups - hits, sharedHits=self.shared_hits,
+                    hitRatio=hits / lookups if lookups else 0.0, savedSeconds=round(self.saved_seconds, 3))
@@ -9,12 +9,6 @@ from faker import Faker
 fake = Faker()
 
 
-mongo_uri = os.getenv("MONGO_URI")
-client = MongoClient(mongo_uri)
-db = client.get_default_database()
-collection = db["fingerprints"]
-
-
 resolutions = [(1920, 1080), (1366, 768), (1440, 900), (2560, 1440), (1280, 720)]
 timezones = ["Europe/London", "America/New_York", "Asia/Tokyo", "Australia/Sydney", "Europe/Paris"]
 languages = ["en-GB", "en-US", "ja-JP", "fr-FR", "es-ES"]
@@ -127,7 +121,13 @@ def generate_user_activity(persona_name):
     }
 
 
-def run_indefinite_seeding():
+def connect():
+    """Open the fingerprints collection; kept out of import so benchmarks can reuse the personas."""
+    client = MongoClient(os.getenv("MONGO_URI"))
+    return client.get_default_database()["fingerprints"]
+
+
+def run_indefinite_seeding(collection):
     """Run indefinitely, inserting one record at a time for each persona."""
     print("Starting indefinite seeding process... Press Ctrl+C to stop.")
 
@@ -154,9 +154,11 @@ def run_indefinite_seeding():
 
 
 if __name__ == "__main__":
+    collection = connect()
+
     # Clear existing data (optional, comment out if not desired)
     collection.delete_many({})
     print("Cleared existing data in collection.")
 
     # Run indefinite seeding
-    run_indefinite_seeding()
+    run_indefinite_seeding(collection)
@@ -0,0 +1,122 @@
+import time
+import threading
+import uuid
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+
+class ExplanationJobs:
+    """Runs LLM explanations on a bounded worker pool so the score can be returned at once.
+
+    At most max_workers calls run concurrently and at most max_pending jobs are queued or
+    running; past that submit() returns None and the caller serves the score on its own.
+    Each job must finish within deadline seconds of being submitted, including time spent
+    waiting for a worker. When a collection is given, job states are also written there
+    so any API process can answer for a job, not just the one that ran it.
+    """
+
+    def __init__(self, explain, max_workers=4, max_pending=64, deadline=20.0, ttl=3600, collection=None):
+        self.explain = explain
+        self.deadline = deadline
+        self.ttl = ttl
+        self.collection = collection
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="explain")
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self.rejected = 0
+
+    def ensure_indexes(self):
+        if self.collection is not None:
+            self.collection.create_index("createdAt", expireAfterSeconds=self.ttl)
+
+    def submit(self, *args):
+        """Queue explain(*args); returns the job id, or None if the pool is saturated."""
+        if not self._slots.acquire(blocking=False):
+            self.rejected += 1
+            return None
+        job_id = uuid.uuid4().hex
+        job = {"jobId": job_id, "status": "pending", "reason": None, "error": None,
+               "submitted": time.monotonic(), "createdAt": datetime.utcnow(), "done": threading.Event()}
+        with self._lock:
+            self._jobs[job_id] = job
+        try:
+            self._persist(job)
+            self._executor.submit(self._run, job, args)
+        except Exception:
+            with self._lock:
+                self._jobs.pop(job_id, None)
+            self._slots.release()
+            raise
+        return job_id
+
+    def _run(self, job, args):
+        try:
+            remaining = self.deadline - (time.monotonic() - job["submitted"])
+            if remaining <= 0:
+                raise TimeoutError("Deadline exceeded while waiting for a worker")
+            job["reason"] = self.explain(*args, timeout=remaining)
+            job["status"] = "done"
+        except Exception as e:
+            job["status"] = "failed"
+            job["error"] = str(e)
+        finally:
+            self._slots.release()
+            job["done"].set()
+            try:
+                self._persist(job)
+            except Exception as e:
+                print(f"Could not store explanation job {job['jobId']}: {str(e)}")
+            self._prune()
+
+    def _persist(self, job):
+        if self.collection is not None:
+            self.collection.replace_one({"_id": job["jobId"]}, {
+                "status": job["status"], "reason": job["reason"], "error": job["error"], "createdAt": job["createdAt"]
+            }, upsert=True)
+
+    def _prune(self):
+        cutoff = time.monotonic() - self.ttl
+        with self._lock:
+            for job_id in [job_id for job_id, job in self._jobs.items()
+                           if job["done"].is_set() and job["submitted"] < cutoff]:
+                del self._jobs[job_id]
+
+    def get(self, job_id):
+        """The job's public state, or None if it is unknown or has expired."""
+        job = self._jobs.get(job_id)
+        if job is not None:
+            return {"jobId": job_id, "status": job["status"], "reason": job["reason"], "error": job["error"]}
+        if self.collection is not None:
+            doc = self.collection.find_one({"_id": job_id})
+            if doc is not None:
+                return {"jobId": job_id, "status": doc["status"], "reason": doc["reason"], "error": doc["error"]}
+        return None
+
+    def wait(self, job_id, timeout, poll_interval=0.5):
+        """Block until the job finishes or timeout seconds pass; returns its state."""
+        job = self._jobs.get(job_id)
+        if job is not None:
+            job["done"].wait(timeout)
+            return self.get(job_id)
+        # Another process ran the job, so all we can do is poll its stored state
+        give_up = time.monotonic() + timeout
+        state = self.get(job_id)
+        while state is not None and state["status"] == "pending" and time.monotonic() < give_up:
+            time.sleep(poll_interval)
+            state = self.get(job_id)
+        return state
+
+    def shutdown(self, wait=True):
+        """Stop taking jobs; with wait, block until the running and queued ones finish."""
+        self._executor.shutdown(wait=wait)
+
+    def stats(self):
+        with self._lock:
+            statuses = [job["status"] for job in self._jobs.values()]
+        return {
+            "pending": statuses.count("pending"),
+            "done": statuses.count("done"),
+            "failed": statuses.count("failed"),
+            "rejected": self.rejected
+        }
@@ -0,0 +1,96 @@
+import numpy as np
+
+
+FEATURE_COLUMNS = [
+    "headless", "cookiesEnabled", "pageLoadTime",
+    "event_mousemove", "event_keydown", "event_scroll", "event_copy",
+    "ip_is_datacenter", "screen_width", "screen_height",
+    "screen_devicePixelRatio", "viewport_innerWidth", "viewport_innerHeight",
+    "battery_level", "battery_charging", "battery_chargingTime",
+    "hardware_cpuCores", "hardware_deviceMemory"
+]
+
+
+BOOLEAN_COLUMNS = ["headless", "cookiesEnabled", "event_mousemove", "event_keydown",
+                   "event_scroll", "event_copy", "ip_is_datacenter", "battery_charging"]
+
+
+# Mongo field path for each feature column, in FEATURE_COLUMNS order
+FEATURE_FIELDS = [
+    "headless", "cookiesEnabled", "pageLoadTime",
+    "events.mousemove", "events.keydown", "events.scroll", "events.copy",
+    "ipDetails.is_datacenter", "screen.width", "screen.height",
+    "screen.devicePixelRatio", "viewport.innerWidth", "viewport.innerHeight",
+    "battery.level", "battery.charging", "battery.chargingTime",
+    "hardware.cpuCores", "hardware.deviceMemory"
+]
+
+
+FEATURE_PROJECTION = {field: 1 for field in FEATURE_FIELDS}
+FEATURE_PROJECTION["_id"] = 0
+
+
+DEFAULT_BATCH_SIZE = 1000
+
+
+def extract_features(record):
+    """Flatten a fingerprint document into a tuple of feature values."""
+    events = record["events"]
+    screen = record["screen"]
+    viewport = record["viewport"]
+    battery = record["battery"]
+    hardware = record["hardware"]
+    return (
+        record["headless"], record["cookiesEnabled"], record["pageLoadTime"],
+        events["mousemove"], events["keydown"], events["scroll"], events["copy"],
+        record["ipDetails"]["is_datacenter"], screen["width"], screen["height"],
+        screen["devicePixelRatio"], viewport["innerWidth"], viewport["innerHeight"],
+        battery["level"], battery["charging"], battery["chargingTime"],
+        hardware["cpuCores"], hardware["deviceMemory"]
+    )
+
+
+def build_feature_matrix(records, capacity=DEFAULT_BATCH_SIZE):
+    """Fill a float32 feature matrix straight from an iterable of fingerprint documents.
+
+    Booleans land as 0.0/1.0, which is exactly what the LabelEncoders fitted on
+    [0, 1] produced, and sklearn's trees score on float32 anyway, so the matrix
+    can be passed to predict as-is.
+    """
+    matrix = np.empty((max(capacity, 1), len(FEATURE_COLUMNS)), dtype=np.float32)
+    count = 0
+    for record in records:
+        if count == matrix.shape[0]:
+            matrix = np.resize(matrix, (matrix.shape[0] * 2, len(FEATURE_COLUMNS)))
+        matrix[count] = extract_features(record)
+        count += 1
+    return matrix[:count]
+
+
+def build_keyed_feature_matrix(records, key_field, capacity=DEFAULT_BATCH_SIZE):
+    """Like build_feature_matrix, but also return the key_field value of every row."""
+    matrix = np.empty((max(capacity, 1), len(FEATURE_COLUMNS)), dtype=np.float32)
+    keys = []
+    count = 0
+    for record in records:
+        if count == matrix.shape[0]:
+            matrix = np.resize(matrix, (matrix.shape[0] * 2, len(FEATURE_COLUMNS)))
+        matrix[count] = extract_features(record)
+        keys.append(record[key_field])
+        count += 1
+    return matrix[:count], keys
+
+
+def fetch_users_feature_matrix(collection, user_ids, batch_size=DEFAULT_BATCH_SIZE):
+    """Fetch the feature rows of many users with a single $in query, keyed by userId."""
+    projection = dict(FEATURE_PROJECTION, userId=1)
+    cursor = collection.find({"userId": {"$in": list(user_ids)}}, projection, batch_size=batch_size)
+    return build_keyed_feature_matrix(cursor, "userId", capacity=batch_size)
+
+
+def mean_by_key(scores, keys):
+    """Average scores per key; returns the unique keys, their means and row counts."""
+    unique_keys, inverse = np.unique(np.asarray(keys, dtype=object), return_inverse=True)
+    counts = np.bincount(inverse, minlength=len(unique_keys))
+    sums = np.bincount(inverse, weights=scores, minlength=len(unique_keys))
+    return unique_keys, sums / counts, counts
@@ -0,0 +1,139 @@
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+
+
+ROW_CHUNK_SIZE = 8192
+ARRAY_NAMES = ["children", "feature", "threshold", "value", "roots"]
+HEADER_FILE = "forest.json"
+
+
+class FlatForest:
+    """A RandomForestRegressor exported to flat node arrays and scored by vectorized traversal.
+
+    All trees share one set of contiguous node arrays; roots holds each tree's first node.
+    Leaves point back at themselves, so every row can step max_depth times through all
+    trees at once without checking which rows have already landed.
+
+    children[2 * node + went_left] is the next node, so one take replaces a where.
+    """
+
+    def __init__(self, children, feature, threshold, value, roots, max_depth, version=None):
+        self.children = children
+        self.feature = feature
+        self.threshold = threshold
+        self.value = value
+        self.roots = roots
+        self.max_depth = max_depth
+        self.version = version
+
+    @classmethod
+    def from_sklearn(cls, model, version=None):
+        """Export the fitted trees of a sklearn forest regressor."""
+        trees = [estimator.tree_ for estimator in model.estimators_]
+        sizes = np.array([tree.node_count for tree in trees])
+        roots = np.concatenate(([0], np.cumsum(sizes)[:-1])).astype(np.int32)
+
+        children_left = np.empty(sizes.sum(), dtype=np.int32)
+        children_right = np.empty(sizes.sum(), dtype=np.int32)
+        feature = np.empty(sizes.sum(), dtype=np.int32)
+        threshold = np.empty(sizes.sum(), dtype=np.float64)
+        value = np.empty(sizes.sum(), dtype=np.float64)
+
+        for tree, root, size in zip(trees, roots, sizes):
+            nodes = slice(root, root + size)
+            is_leaf = tree.children_left == -1
+            own_index = np.arange(root, root + size)
+            children_left[nodes] = np.where(is_leaf, own_index, tree.children_left + root)
+            children_right[nodes] = np.where(is_leaf, own_index, tree.children_right + root)
+            feature[nodes] = np.where(is_leaf, 0, tree.feature)
+            threshold[nodes] = np.where(is_leaf, 0.0, tree.threshold)
+            value[nodes] = tree.value[:, 0, 0]
+
+        max_depth = max(tree.max_depth for tree in trees)
+        children = np.stack([children_right, children_left], axis=1).ravel().astype(np.intp)
+        return cls(children, feature, threshold, value, roots, max_depth, version)
+
+    def save(self, path):
+        """Write the node arrays as .npy files plus a small JSON header, published at path.
+
+        The files go into a new directory next to path, and path is a symlink that
+        os.replace switches to it, so a reader finds the old artifact or the new one but
+        never a half-written or missing one. The previous directory is kept for loaders
+        that resolved path just before the switch; older ones are removed.
+        """
+        path = os.path.abspath(path.rstrip("/"))
+        parent, name = os.path.split(path)
+        prefix = f"{name}.v-"
+        data_dir = tempfile.mkdtemp(prefix=prefix, dir=parent)
+        os.chmod(data_dir, 0o755)
+        for array_name in ARRAY_NAMES:
+            np.save(os.path.join(data_dir, f"{array_name}.npy"), getattr(self, array_name))
+        with open(os.path.join(data_dir, HEADER_FILE), "w") as f:
+            json.dump({"max_depth": int(self.max_depth), "version": self.version}, f)
+
+        previous = os.path.join(parent, os.readlink(path)) if os.path.islink(path) else None
+        if os.path.isdir(path) and not os.path.islink(path):
+            # An artifact saved before path became a symlink; moving it aside is not atomic,
+            # but only happens once
+            previous = os.path.join(parent, f"{prefix}legacy-{os.getpid()}")
+            os.rename(path, previous)
+        link = os.path.join(parent, f".{name}.link-{os.getpid()}")
+        os.symlink(os.path.basename(data_dir), link)
+        os.replace(link, path)
+
+        keep = {data_dir, previous}
+        for entry in os.listdir(parent):
+            stale = os.path.join(parent, entry)
+            if entry.startswith(prefix) and stale not in keep and not os.path.islink(stale):
+                shutil.rmtree(stale, ignore_errors=True)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """Load a saved forest; with mmap the arrays are mapped read-only from the files.
+
+        Mapped pages live in the page cache, so every process scoring with the same
+        artifact shares a single copy of the trees. path is resolved once per attempt, so
+        the header and arrays come from the same artifact even if save() switches it; if
+        that artifact is removed mid-load by later saves, the new one is loaded instead.
+        """
+        while True:
+            artifact = os.path.realpath(path)
+            try:
+                with open(os.path.join(artifact, HEADER_FILE)) as f:
+                    header = json.load(f)
+                arrays = {name: np.load(os.path.join(artifact, f"{name}.npy"), mmap_mode="r" if mmap else None)
+                          for name in ARRAY_NAMES}
+                return cls(max_depth=header["max_depth"], version=header["version"], **arrays)
+            except FileNotFoundError:
+                if os.path.realpath(path) == artifact:
+                    raise
+
+    @property
+    def n_estimators(self):
+        return len(self.roots)
+
+    def apply(self, X):
+        """Return the leaf index reached in every tree, shaped (n_rows, n_trees)."""
+        # Gather through flat offsets: one take per array beats 2-D fancy indexing
+        flat_X = X.ravel()
+        row_offsets = (np.arange(X.shape[0], dtype=np.intp) * X.shape[1])[:, None]
+        nodes = np.repeat(self.roots[None, :].astype(np.intp), X.shape[0], axis=0)
+        for _ in range(self.max_depth):
+            go_left = flat_X.take(row_offsets + self.feature.take(nodes)) <= self.threshold.take(nodes)
+            nodes = self.children.take(nodes * 2 + go_left)
+        return nodes
+
+    def predict(self, X):
+        """Average the trees' leaf values, summing in tree order exactly like sklearn."""
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        predictions = np.empty(X.shape[0], dtype=np.float64)
+        for start in range(0, X.shape[0], ROW_CHUNK_SIZE):
+            leaf_values = self.value[self.apply(X[start:start + ROW_CHUNK_SIZE])]
+            total = np.zeros(leaf_values.shape[0], dtype=np.float64)
+            for tree_index in range(leaf_values.shape[1]):
+                total += leaf_values[:, tree_index]
+            predictions[start:start + ROW_CHUNK_SIZE] = total / self.n_estimators
+        return predictions
@@ -0,0 +1,66 @@
+import gc
+import multiprocessing
+import os
+import tempfile
+
+
+# gunicorn -c gunicorn.conf.py api:app
+#
+# The master imports the app and loads the model once; workers are forked from it and
+# share the model's memory copy-on-write. Each worker then opens its own Mongo client
+# and warms up, and /ready reports per worker. A worker picks up new model artifacts
+# through MODEL_WATCH_INTERVAL; SIGHUP belongs to gunicorn here and restarts the
+# workers from the master's copy of the model. The admin reload and rollback endpoints
+# reach one worker, which records the outcome in MODEL_STATE_PATH for the others.
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8080')}"
+workers = int(os.getenv("GUNICORN_WORKERS", str(multiprocessing.cpu_count())))
+threads = int(os.getenv("GUNICORN_THREADS", "4"))
+worker_class = "gthread"
+preload_app = True
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "60"))
+graceful_timeout = int(os.getenv("GUNICORN_GRACEFUL_TIMEOUT", "30"))
+keepalive = 5
+accesslog = "-" if os.getenv("GUNICORN_ACCESS_LOG", "0") == "1" else None
+
+# Split the cores between the workers' predict threads, and size each worker's Mongo pool
+# to its request threads instead of pymongo's default of 100 connections per process
+os.environ.setdefault("PREDICT_THREADS", str(max(1, multiprocessing.cpu_count() // workers)))
+os.environ.setdefault("MONGO_MAX_POOL_SIZE", str(threads * 2))
+os.environ["WARM_UP_ON_IMPORT"] = "0"
+# Workers write their metrics here and /metrics merges them, whichever worker answers
+os.environ.setdefault("METRICS_MULTIPROC_DIR",
+                      os.path.join(tempfile.gettempdir(), f"ppric-metrics-{os.getenv('PORT', '8080')}"))
+os.environ.setdefault("MODEL_STATE_PATH",
+                      os.path.join(tempfile.gettempdir(), f"ppric-model-{os.getenv('PORT', '8080')}.json"))
+
+
+def on_starting(server):
+    from metrics import clear_multiprocess_dir
+    clear_multiprocess_dir(os.environ["METRICS_MULTIPROC_DIR"])
+
+
+def when_ready(server):
+    import api
+    api.models.reload()
+    # Keep the collector from touching (and so copying) the objects the workers inherit
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    import api
+    api.connect_mongo()
+    api.start_warm_up()
+
+
+def worker_exit(server, worker):
+    import api
+    # Write buffered fingerprints and let queued explanations finish within graceful_timeout
+    api.ingest_buffer.close()
+    api.explanation_jobs.shutdown(wait=True)
+    api.metrics.write_snapshot()
+
+
+def child_exit(server, worker):
+    from metrics import mark_process_dead
+    mark_process_dead(os.environ["METRICS_MULTIPROC_DIR"], worker.pid)
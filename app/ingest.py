@@ -0,0 +1,248 @@
+import bisect
+import threading
+import time
+from datetime import datetime
+from pymongo import WriteConcern
+from pymongo.errors import BulkWriteError
+
+
+NUMBER = (int, float)
+STRING = (str,)
+BOOLEAN = (bool,)
+
+
+# Fields of a fingerprint as console.generate_user_activity produces them; serverTimestamp
+# is set on ingest. Fields marked optional may be missing but must have the type if present.
+FINGERPRINT_SCHEMA = [
+    ("userId", STRING, True),
+    ("timestamp", (int,), True),
+    ("fingerprint", STRING, False),
+    ("timezone", STRING, False),
+    ("language", STRING, False),
+    ("headless", BOOLEAN, True),
+    ("cookiesEnabled", BOOLEAN, True),
+    ("pageLoadTime", NUMBER, True),
+    ("events.mousemove", BOOLEAN, True),
+    ("events.keydown", BOOLEAN, True),
+    ("events.scroll", BOOLEAN, True),
+    ("events.copy", BOOLEAN, True),
+    ("ipDetails.country", STRING, False),
+    ("ipDetails.asn", STRING, False),
+    ("ipDetails.is_datacenter", BOOLEAN, True),
+    ("screen.width", NUMBER, True),
+    ("screen.height", NUMBER, True),
+    ("screen.devicePixelRatio", NUMBER, True),
+    ("screen.orientation", STRING, False),
+    ("viewport.innerWidth", NUMBER, True),
+    ("viewport.innerHeight", NUMBER, True),
+    ("battery.level", NUMBER, True),
+    ("battery.charging", BOOLEAN, True),
+    ("battery.chargingTime", NUMBER, True),
+    ("hardware.cpuCores", NUMBER, True),
+    ("hardware.deviceMemory", NUMBER, True),
+]
+COMPILED_SCHEMA = [(field, field.split("."), types, required) for field, types, required in FINGERPRINT_SCHEMA]
+
+
+def validate_fingerprint(document):
+    """Check a fingerprint event against FINGERPRINT_SCHEMA; raises ValueError naming the bad field.
+
+    Returns the document with serverTimestamp set and any client-supplied _id removed.
+    """
+    if not isinstance(document, dict):
+        raise ValueError("Event must be a JSON object")
+    for field, path, types, required in COMPILED_SCHEMA:
+        value = document
+        for key in path:
+            value = value.get(key) if isinstance(value, dict) else None
+        if value is None:
+            if required:
+                raise ValueError(f"{field} is required")
+            continue
+        # bool is an int subclass, so it has to be ruled out for numbers explicitly
+        if not isinstance(value, types) or (types is not BOOLEAN and isinstance(value, bool)):
+            raise ValueError(f"{field} must be {'a boolean' if types is BOOLEAN else 'a ' + types[0].__name__}")
+    document.pop("_id", None)
+    document["serverTimestamp"] = datetime.utcnow().isoformat()
+    return document
+
+
+class WriteRejected(Exception):
+    """Raised by a WriteBehindBuffer write function for documents that retrying will not write."""
+
+
+def write_concern_from_env(w, journal):
+    """WriteConcern from INGEST_WRITE_CONCERN ("0", "1", "majority", ...) and INGEST_JOURNAL."""
+    return WriteConcern(w=int(w) if w.isdigit() else w, j=journal or None)
+
+
+class WriteBehindBuffer:
+    """Buffers inserts in memory and writes them with unordered insert_many from a background thread.
+
+    A flush happens once max_batch documents are waiting or flush_interval seconds after
+    the oldest one arrived. At most max_buffered documents are held; add() refuses
+    batches past that so callers can push back on clients instead of growing without
+    bound. Documents are numbered as they are accepted, and wait() blocks until a given
+    number has been written. Failed network writes are retried in order; documents the
+    server rejects (duplicate keys, validation) are counted and dropped, and wait()
+    reports them to the callers waiting on them. A write function replaces insert_many,
+    as for the bucketed layout; it must remove the documents it has written from the
+    batch before raising, so that a retry does not write them twice. WriteRejected or
+    BulkWriteError from it rejects the documents left in the batch; other errors are
+    retried.
+    """
+
+    def __init__(self, collection, max_batch=1000, flush_interval=0.05, max_buffered=50000,
+                 write_concern=None, retry_interval=1.0, write=None):
+        self.collection = collection
+        self.write = write
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.max_buffered = max_buffered
+        self.write_concern = write_concern
+        self.retry_interval = retry_interval
+        self._pending = []
+        self._oldest = None
+        self._accepted = 0
+        self._written = 0
+        # Sequence numbers of rejected documents, kept for the last max_buffered documents written
+        self._failed_sequences = []
+        self._condition = threading.Condition()
+        self._thread = None
+        self._closed = False
+        self.inserted = 0
+        self.failed = 0
+        self.rejected = 0
+        self.flushes = 0
+
+    def add(self, documents):
+        """Queue documents for insertion; returns the sequence number of the last one, or None if full."""
+        with self._condition:
+            if self._closed or len(self._pending) + len(documents) > self.max_buffered:
+                self.rejected += len(documents)
+                return None
+            was_empty = not self._pending
+            if was_empty:
+                self._oldest = time.monotonic()
+            self._pending.extend(documents)
+            self._accepted += len(documents)
+            if self._thread is None:
+                # Started on first use so that a pre-fork server starts one per worker
+                self._thread = threading.Thread(target=self._run, name="ingest-flush", daemon=True)
+                self._thread.start()
+            # Wake the flusher to start the flush_interval timer, or to write a full batch
+            if was_empty or len(self._pending) >= self.max_batch:
+                self._condition.notify_all()
+            return self._accepted
+
+    def wait(self, sequence, timeout, count=1):
+        """Block until the count documents ending at sequence have been written.
+
+        Returns how many of them the server rejected, or None if they were not all
+        written within timeout.
+        """
+        with self._condition:
+            if not self._condition.wait_for(lambda: self._written >= sequence, timeout):
+                return None
+            return (bisect.bisect_right(self._failed_sequences, sequence)
+                    - bisect.bisect_left(self._failed_sequences, sequence - count + 1))
+
+    def _next_batch(self):
+        with self._condition:
+            while True:
+                if self._pending:
+                    due = self._oldest + self.flush_interval
+                    if len(self._pending) >= self.max_batch or time.monotonic() >= due or self._closed:
+                        batch = self._pending[:self.max_batch]
+                        del self._pending[:self.max_batch]
+                        self._oldest = time.monotonic() if self._pending else None
+                        return batch
+                    self._condition.wait(due - time.monotonic())
+                elif self._closed:
+                    return None
+                else:
+                    self._condition.wait()
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            collection = self.collection
+            if self.write_concern is not None:
+                collection = collection.with_options(write_concern=self.write_concern)
+            size = len(batch)
+            # Batches are taken and written in order, so they are numbered from _written on
+            sequences = {id(document): self._written + 1 + index for index, document in enumerate(batch)}
+            failed = []
+            retried = False
+            while True:
+                try:
+                    if self.write is not None:
+                        self.write(collection, batch)
+                    else:
+                        collection.insert_many(batch, ordered=False)
+                    break
+                except BulkWriteError as e:
+                    write_errors = e.details.get("writeErrors", [])
+                    if self.write is not None:
+                        failed = list(batch)
+                    else:
+                        if retried:
+                            write_errors = self._not_stored(collection, batch, write_errors)
+                        failed = [batch[error["index"]] for error in write_errors]
+                    if failed:
+                        print(f"Ingest flush rejected {len(failed)} documents: "
+                              f"{(write_errors or [{}])[0].get('errmsg', str(e))}")
+                    break
+                except WriteRejected as e:
+                    failed = list(batch)
+                    print(f"Ingest flush rejected {len(failed)} documents: {str(e)}")
+                    break
+                except Exception as e:
+                    print(f"Ingest flush failed, retrying in {self.retry_interval:g} seconds: {str(e)}")
+                    retried = True
+                    time.sleep(self.retry_interval)
+            with self._condition:
+                self.inserted += size - len(failed)
+                self.failed += len(failed)
+                self.flushes += 1
+                self._failed_sequences.extend(sorted(sequences[id(document)] for document in failed))
+                self._written += size
+                del self._failed_sequences[:bisect.bisect_right(self._failed_sequences,
+                                                                self._written - self.max_buffered)]
+                self._condition.notify_all()
+
+    def _not_stored(self, collection, batch, write_errors):
+        """The write errors whose document's _id is not in the collection.
+
+        insert_many gives every document its _id on the first attempt, so after a retry the
+        documents rejected as duplicates may be ones an interrupted attempt already stored.
+        """
+        try:
+            stored = {doc["_id"] for doc in collection.find(
+                {"_id": {"$in": [batch[error["index"]]["_id"] for error in write_errors]}}, {"_id": 1})}
+        except Exception as e:
+            print(f"Could not check which rejected documents were stored: {str(e)}")
+            return write_errors
+        return [error for error in write_errors if batch[error["index"]]["_id"] not in stored]
+
+    def close(self, timeout=None):
+        """Stop accepting documents and wait for the buffered ones to be written."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def stats(self):
+        with self._condition:
+            buffered = len(self._pending)
+        return {
+            "buffered": buffered,
+            "maxBuffered": self.max_buffered,
+            "inserted": self.inserted,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "flushes": self.flushes
+        }
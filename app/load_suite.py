@@ -0,0 +1,362 @@
+import argparse
+import copy
+import http.client
+import json
+import os
+import random
+import subprocess
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import pymongo
+from console import personas, generate_user_activity
+from loadtest import APP_DIR, start_server, wait_until_ready
+import buckets
+
+
+# Synthetic users are named after this prefix and their history depth, and replaced on every run
+USER_PREFIX = "loadtest-"
+ENDPOINTS = ["limit-increase", "user-activity"]
+
+
+class StubLLMHandler(BaseHTTPRequestHandler):
+    """Answers OpenAI-style /chat/completions after the server's configured latency."""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        time.sleep(self.server.latency)
+        prompt = "".join(message.get("content", "") for message in body.get("messages", []))
+        payload = json.dumps({
+            "id": "stub",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "stub"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": "Stub explanation for load testing."},
+                "finish_reason": "stop"
+            }],
+            "usage": {"prompt_tokens": len(prompt) // 4, "completion_tokens": 8,
+                      "total_tokens": len(prompt) // 4 + 8}
+        }).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stub_llm(latency):
+    """Serve the stub LLM on a free local port; returns (server, base_url) for GROK_BASE_URL."""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubLLMHandler)
+    server.daemon_threads = True
+    server.latency = latency
+    threading.Thread(target=server.serve_forever, name="stub-llm", daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}/v1"
+
+
+def start_in_process(port):
+    """Serve api.app from this process against an in-memory mongomock database; returns the api module.
+
+    Clients and server share one interpreter (and its GIL), so the numbers are only good
+    for comparing runs made the same way.
+    """
+    try:
+        import mongomock
+    except ImportError:
+        raise SystemExit("--memory needs mongomock: pip install mongomock")
+    from werkzeug.serving import WSGIRequestHandler, make_server
+
+    class QuietRequestHandler(WSGIRequestHandler):
+        def log_request(self, *args):
+            pass
+
+    # mongomock edits the projection it is given, and the app shares its projections between threads
+    find = mongomock.collection.Collection.find
+
+    def find_with_own_projection(self, filter=None, projection=None, *args, **kwargs):
+        return find(self, filter, copy.deepcopy(projection), *args, **kwargs)
+
+    mongomock.collection.Collection.find = find_with_own_projection
+    pymongo.MongoClient = mongomock.MongoClient
+    # api.py opens the URI's default database at import; no server is contacted
+    os.environ["MONGO_URI"] = "mongodb://localhost/load_suite"
+    # The app loads its model relative to the working directory, as under gunicorn
+    os.chdir(APP_DIR)
+    import api
+    server = make_server("127.0.0.1", port, api.app, threaded=True, request_handler=QuietRequestHandler)
+    threading.Thread(target=server.serve_forever, name="api-server", daemon=True).start()
+    return api
+
+
+def populate(db, users, depths, seed=42, spacing=60):
+    """Insert users synthetic users for each history depth, spacing seconds between events.
+
+    Each user takes its traits from one of console.py's personas in turn. Earlier load
+    test users are removed first. Returns [(userId, depth)].
+    """
+    random.seed(seed)
+    persona_names = list(personas)
+    collection = db["fingerprints"]
+    stale = {"userId": {"$regex": f"^{USER_PREFIX}"}}
+    for name in ("fingerprints", "fingerprint_buckets", "user_scores"):
+        db[name].delete_many(stale)
+
+    now = int(time.time() * 1000)
+    targets = []
+    batch = []
+    for depth in depths:
+        for i in range(users):
+            user_id = f"{USER_PREFIX}{depth}-{i}"
+            persona_name = persona_names[i % len(persona_names)]
+            for n in range(depth):
+                record = generate_user_activity(persona_name)
+                record["userId"] = user_id
+                record["timestamp"] = now - (depth - n) * spacing * 1000
+                batch.append(record)
+                if len(batch) >= 5000:
+                    collection.insert_many(batch, ordered=False)
+                    batch = []
+            targets.append((user_id, depth))
+    if batch:
+        collection.insert_many(batch, ordered=False)
+
+    if os.getenv("STORAGE_LAYOUT", "documents") == "bucketed":
+        buckets.migrate(collection, db["fingerprint_buckets"], query=stale)
+    return targets
+
+
+def request_body(endpoint, user_id, page_size):
+    if endpoint == "limit-increase":
+        return {"userId": user_id, "async": False}
+    return {"userId": user_id, "limit": page_size} if page_size else {"userId": user_id}
+
+
+def drive(port, endpoint, targets, concurrency, duration, rate=None, page_size=100):
+    """Send requests for random targets to one endpoint; returns [(depth, seconds, ok)].
+
+    Without a rate, concurrency clients send back to back. With one, requests are due
+    every 1/rate seconds and claimed in turn by concurrency clients, and latency counts
+    from when a request was due, so a server that falls behind shows up in the
+    percentiles instead of quietly slowing the load down.
+    """
+    samples = []
+    lock = threading.Lock()
+    next_slot = [0]
+    start = time.monotonic()
+    stop_at = start + duration
+    path = f"/{endpoint}"
+
+    def client():
+        rng = random.Random()
+        connection = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+        own_samples = []
+        while True:
+            if rate:
+                with lock:
+                    due = start + next_slot[0] / rate
+                    next_slot[0] += 1
+                if due >= stop_at:
+                    break
+                time.sleep(max(0.0, due - time.monotonic()))
+                began = due
+            else:
+                began = time.monotonic()
+                if began >= stop_at:
+                    break
+            user_id, depth = rng.choice(targets)
+            body = json.dumps(request_body(endpoint, user_id, page_size))
+            try:
+                connection.request("POST", path, body, {"Content-Type": "application/json"})
+                response = connection.getresponse()
+                response.read()
+                ok = response.status == 200
+            except OSError:
+                ok = False
+                connection.close()
+                connection = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+            own_samples.append((depth, time.monotonic() - began, ok))
+        connection.close()
+        with lock:
+            samples.extend(own_samples)
+
+    clients = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+    return samples
+
+
+def latency_stats(latencies, errors, duration):
+    stats = {"requests": len(latencies) + errors, "errors": errors,
+             "throughput": round(len(latencies) / duration, 2)}
+    if len(latencies):
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) * 1000
+        stats.update(p50Ms=round(p50, 2), p95Ms=round(p95, 2), p99Ms=round(p99, 2),
+                     meanMs=round(float(np.mean(latencies)) * 1000, 2))
+    return stats
+
+
+def summarize(samples, duration):
+    """Throughput (successful requests per second) and latency percentiles, overall and by history depth."""
+    def stats(selected):
+        latencies = np.array([seconds for _, seconds, ok in selected if ok])
+        return latency_stats(latencies, sum(1 for _, _, ok in selected if not ok), duration)
+
+    depths = sorted({depth for depth, _, _ in samples})
+    return {
+        "all": stats(samples),
+        "byHistory": {str(depth): stats([s for s in samples if s[0] == depth]) for depth in depths}
+    }
+
+
+def git_revision():
+    """(commit, dirty) of the working tree, or (None, None) outside a git checkout."""
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=APP_DIR, capture_output=True,
+                                text=True, check=True).stdout.strip()
+        status = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=APP_DIR,
+                                capture_output=True, text=True, check=True).stdout
+        return commit, bool(status.strip())
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+
+
+def print_results(results):
+    print(f"{'endpoint':<16}{'history':>8}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'errors':>8}")
+    for endpoint, summary in results.items():
+        rows = [("all", summary["all"])] + list(summary["byHistory"].items())
+        for history, stats in rows:
+            percentiles = "".join(f"{stats.get(key, float('nan')):>10.1f}" for key in ("p50Ms", "p95Ms", "p99Ms"))
+            print(f"{endpoint:<16}{history:>8}{stats['throughput']:>10.1f}{percentiles}{stats['errors']:>8}")
+
+
+def compare(previous_path, runs):
+    """Print the change in throughput and p99 against a saved run, matched by workers, endpoint and history."""
+    with open(previous_path) as f:
+        previous = json.load(f)
+    print(f"Compared with {previous_path} (commit {(previous.get('commit') or 'unknown')[:12]}):")
+    earlier = {run["workers"]: run["results"] for run in previous["runs"]}
+    for run in runs:
+        for endpoint, summary in run["results"].items():
+            before_summary = earlier.get(run["workers"], {}).get(endpoint)
+            if before_summary is None:
+                continue
+            for history, stats in [("all", summary["all"])] + list(summary["byHistory"].items()):
+                before = before_summary["all"] if history == "all" else before_summary["byHistory"].get(history)
+                if not before or "p99Ms" not in before or "p99Ms" not in stats:
+                    continue
+                print(f"{endpoint:<16}{history:>8}  req/s {before['throughput']:8.1f} -> {stats['throughput']:8.1f}"
+                      f"  p99 {before['p99Ms']:8.1f} -> {stats['p99Ms']:8.1f} ms")
+
+
+def run_suite(args):
+    # Resolved before --memory moves into the app directory
+    commit, dirty = git_revision()
+    output = os.path.abspath(
+        args.output or f"load-suite-{(commit or 'nogit')[:12]}-{datetime.utcnow():%Y%m%dT%H%M%S}.json")
+    previous = os.path.abspath(args.compare) if args.compare else None
+
+    # The server reads these at import, whether it runs here or under gunicorn
+    stub, base_url = start_stub_llm(args.llm_latency)
+    os.environ["GROK_BASE_URL"] = base_url
+    os.environ.setdefault("GROK_API_KEY", "stub")
+    if not args.explanation_cache:
+        os.environ["EXPLANATION_CACHE_SIZE"] = "0"
+
+    if args.memory:
+        api = start_in_process(args.port)
+        db = api.db
+    else:
+        db = pymongo.MongoClient(os.getenv("MONGO_URI")).get_default_database()
+
+    populate_start = time.perf_counter()
+    targets = populate(db, args.users, args.history, seed=args.seed)
+    print(f"Populated {len(targets)} users with {sum(depth for _, depth in targets)} events "
+          f"in {time.perf_counter() - populate_start:.1f} s")
+
+    mode = f"{args.rate:g} req/s" if args.rate else "closed loop"
+    print(f"{args.concurrency} clients, {mode}, {args.duration:g} s per endpoint, "
+          f"LLM latency {args.llm_latency * 1000:g} ms, {os.cpu_count()} cores")
+    runs = []
+    for workers in [None] if args.memory else args.workers:
+        server = None if args.memory else start_server(workers, args.threads, args.port)
+        try:
+            wait_until_ready(args.port, workers or 1)
+            results = {}
+            for endpoint in args.endpoints:
+                samples = drive(args.port, endpoint, targets, args.concurrency, args.duration,
+                                rate=args.rate, page_size=args.page_size)
+                results[endpoint] = summarize(samples, args.duration)
+        finally:
+            if server is not None:
+                server.terminate()
+                server.wait()
+        if workers is not None:
+            print(f"{workers} workers:")
+        print_results(results)
+        runs.append({"workers": workers, "results": results})
+    stub.shutdown()
+
+    report = {
+        "commit": commit,
+        "dirty": dirty,
+        "timestamp": datetime.utcnow().isoformat(),
+        "cores": os.cpu_count(),
+        "config": {
+            "backend": "memory" if args.memory else "mongo",
+            "storageLayout": os.getenv("STORAGE_LAYOUT", "documents"),
+            "users": args.users,
+            "history": args.history,
+            "endpoints": args.endpoints,
+            "concurrency": args.concurrency,
+            "rate": args.rate,
+            "duration": args.duration,
+            "pageSize": args.page_size,
+            "llmLatency": args.llm_latency,
+            "explanationCache": args.explanation_cache,
+            "threads": None if args.memory else args.threads,
+        },
+        "runs": runs
+    }
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {output}")
+    if previous:
+        compare(previous, runs)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="End-to-end load test: seed persona users, drive the API with a stub LLM and save results as JSON.")
+    parser.add_argument("--users", type=int, default=20, help="Users per history depth")
+    parser.add_argument("--history", type=int, nargs="+", default=[10, 100, 1000],
+                        help="History depths (events per user) to seed and break results out by")
+    parser.add_argument("--endpoints", nargs="+", choices=ENDPOINTS, default=ENDPOINTS)
+    parser.add_argument("--concurrency", type=int, default=16, help="Concurrent keep-alive clients")
+    parser.add_argument("--rate", type=float, help="Target requests per second (default: as fast as the clients go)")
+    parser.add_argument("--duration", type=float, default=20.0, help="Seconds per endpoint")
+    parser.add_argument("--page-size", type=int, default=100, help="/user-activity limit, 0 for the whole history")
+    parser.add_argument("--llm-latency", type=float, default=0.5, help="Seconds the stub LLM takes to answer")
+    parser.add_argument("--explanation-cache", action="store_true",
+                        help="Keep the explanation cache on (by default every /limit-increase calls the LLM)")
+    parser.add_argument("--memory", action="store_true",
+                        help="Serve the app in-process on an in-memory mongomock database instead of "
+                             "gunicorn against MONGO_URI")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1], help="gunicorn worker counts to run")
+    parser.add_argument("--threads", type=int, default=4, help="Threads per gunicorn worker")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="JSON results file (default: load-suite-<commit>-<time>.json)")
+    parser.add_argument("--compare", help="Earlier JSON results to compare against")
+    args = parser.parse_args()
+
+    run_suite(args)
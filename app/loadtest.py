@@ -0,0 +1,117 @@
+import argparse
+import http.client
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+import numpy as np
+from pymongo import MongoClient
+
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def start_server(workers, threads, port):
+    """Start gunicorn with the given worker count; returns the process."""
+    env = dict(os.environ, GUNICORN_WORKERS=str(workers), GUNICORN_THREADS=str(threads), PORT=str(port))
+    return subprocess.Popen([sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "api:app"],
+                            cwd=APP_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def wait_until_ready(port, workers, timeout=120):
+    """Poll /ready until enough consecutive answers are 200 that every worker has likely warmed up."""
+    give_up = time.monotonic() + timeout
+    ready_in_a_row = 0
+    while ready_in_a_row < workers * 3:
+        if time.monotonic() > give_up:
+            raise TimeoutError(f"Server on port {port} did not become ready in {timeout} seconds")
+        try:
+            connection = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+            connection.request("GET", "/ready")
+            ready = connection.getresponse().status == 200
+            connection.close()
+        except OSError:
+            ready = False
+        ready_in_a_row = ready_in_a_row + 1 if ready else 0
+        if not ready:
+            time.sleep(0.2)
+
+
+def run_clients(port, user_ids, concurrency, duration, batch_size):
+    """Hit /limit-increase/batch from concurrency keep-alive clients; returns (latencies, errors)."""
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    stop_at = time.monotonic() + duration
+
+    def client():
+        rng = random.Random()
+        connection = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+        own_latencies = []
+        own_errors = 0
+        while time.monotonic() < stop_at:
+            body = json.dumps({"userIds": rng.sample(user_ids, min(batch_size, len(user_ids)))})
+            start_time = time.perf_counter()
+            try:
+                connection.request("POST", "/limit-increase/batch", body, {"Content-Type": "application/json"})
+                response = connection.getresponse()
+                response.read()
+                if response.status == 200:
+                    own_latencies.append(time.perf_counter() - start_time)
+                else:
+                    own_errors += 1
+            except OSError:
+                own_errors += 1
+                connection.close()
+                connection = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+        with lock:
+            latencies.extend(own_latencies)
+            errors[0] += own_errors
+
+    clients = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+    return np.array(latencies), errors[0]
+
+
+def load_test(worker_counts, threads, concurrency, duration, batch_size, port):
+    """Throughput and latency of batch scoring for each gunicorn worker count."""
+    db = MongoClient(os.getenv("MONGO_URI")).get_default_database()
+    user_ids = db["fingerprints"].distinct("userId")
+    if not user_ids:
+        raise SystemExit("No fingerprints to score; populate the database first (see console.py)")
+
+    print(f"{len(user_ids)} users, {concurrency} clients, {batch_size} users per request, "
+          f"{duration:g} s per run, {os.cpu_count()} cores")
+    for workers in worker_counts:
+        server = start_server(workers, threads, port)
+        try:
+            wait_until_ready(port, workers)
+            latencies, errors = run_clients(port, user_ids, concurrency, duration, batch_size)
+        finally:
+            server.terminate()
+            server.wait()
+        if not len(latencies):
+            print(f"{workers:>3} workers: no successful requests, {errors} errors")
+            continue
+        p50, p99 = np.percentile(latencies, [50, 99]) * 1000
+        print(f"{workers:>3} workers: {len(latencies) / duration:8.1f} req/s, "
+              f"p50 {p50:7.1f} ms, p99 {p99:7.1f} ms, {errors} errors")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure how API throughput scales with gunicorn workers.")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--threads", type=int, default=4, help="Threads per worker")
+    parser.add_argument("--concurrency", type=int, default=16, help="Concurrent keep-alive clients")
+    parser.add_argument("--duration", type=float, default=20.0, help="Seconds per worker count")
+    parser.add_argument("--batch-size", type=int, default=1, help="userIds per /limit-increase/batch request")
+    parser.add_argument("--port", type=int, default=8081)
+    args = parser.parse_args()
+
+    load_test(args.workers, args.threads, args.concurrency, args.duration, args.batch_size, args.port)
@@ -0,0 +1,320 @@
+import bisect
+import fcntl
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from flask import g, has_request_context
+
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(names, values, extra=""):
+    pairs = [f'{name}="{escape_label(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.values = {}
+
+    def inc(self, amount=1, *label_values):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def merge(self, label_values, value):
+        self.inc(value, *label_values)
+
+    def samples(self):
+        for label_values, value in sorted(self.values.items()):
+            yield f"{self.name}{format_labels(self.labels, label_values)} {value:g}"
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value, *label_values):
+        self.values[label_values] = value
+
+    def merge(self, label_values, value):
+        self.set(value, *label_values)
+
+    def clear(self):
+        self.values.clear()
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = buckets
+        self.values = {}
+
+    def observe(self, value, *label_values):
+        series = self.values.get(label_values)
+        if series is None:
+            series = self.values[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def merge(self, label_values, other):
+        series = self.values.get(label_values)
+        if series is None:
+            self.values[label_values] = [list(other[0]), other[1]]
+        else:
+            series[0] = [count + other_count for count, other_count in zip(series[0], other[0])]
+            series[1] += other[1]
+
+    def samples(self):
+        for label_values, (counts, total) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{bound:g}"'
+                yield f"{self.name}_bucket{format_labels(self.labels, label_values, le)} {cumulative}"
+            yield f"{self.name}_sum{format_labels(self.labels, label_values)} {total:g}"
+            yield f"{self.name}_count{format_labels(self.labels, label_values)} {cumulative}"
+
+
+class NullStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NULL_STAGE = NullStage()
+
+
+class Stage:
+    """Times a block into the stage histogram, counting an error for the stage if it raises."""
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        elapsed = time.perf_counter() - self.start
+        with self.metrics.lock:
+            self.metrics.stage_seconds.observe(elapsed, self.name)
+            if exc_type is not None:
+                self.metrics.errors.inc(1, self.name)
+        if self.metrics.server_timing and has_request_context():
+            g.setdefault("stage_timings", []).append((self.name, elapsed))
+        return False
+
+
+class Metrics:
+    """Request metrics, rendered in the Prometheus text format.
+
+    Stages are timed with `with metrics.stage("predict"):`. When disabled, stage()
+    returns a shared no-op context manager and the other methods return at once, so
+    the instrumented code pays one attribute check.
+
+    Each process records into its own registry. Under a pre-fork server, give every
+    worker the same multiprocess_dir: a worker writes a snapshot of its registry there
+    every flush_interval seconds (and when it renders), and render() merges all of
+    them, so a scrape answered by any worker sees the whole server. The server must
+    call mark_process_dead() for each worker that exits, which folds the worker's
+    counters and histograms into an archive so that totals never go backwards.
+    """
+
+    def __init__(self, enabled=True, server_timing=False, multiprocess_dir=None, flush_interval=1.0):
+        self.enabled = enabled
+        self.server_timing = enabled and server_timing
+        self.multiprocess_dir = multiprocess_dir if enabled else None
+        self.flush_interval = flush_interval
+        self._flusher_pid = None
+        self.lock = threading.Lock()
+        self.stage_seconds = Histogram("ppric_stage_seconds", "Time spent in each stage of a request", ("stage",))
+        self.request_seconds = Histogram("ppric_request_seconds", "Request latency by endpoint and status",
+                                         ("endpoint", "status"))
+        self.errors = Counter("ppric_errors_total", "Errors by the stage that raised them", ("stage",))
+        self.counters = {
+            name: Counter(f"ppric_{name}_total", help_text, labels)
+            for name, help_text, labels in [
+                ("records_fetched", "Fingerprint records read from Mongo", ()),
+                ("rows_scored", "Feature rows scored by the model, before cache deduplication", ()),
+                ("prompt_chars", "Characters of prompt sent to the LLM", ()),
+                ("llm_tokens", "LLM tokens used, by kind", ("kind",)),
+                ("events_ingested", "Fingerprint events accepted by POST /fingerprints", ()),
+                ("events_rejected", "Fingerprint events that failed validation", ()),
+            ]
+        }
+        self.model_info = Gauge("ppric_model_info", "The model version each worker is serving", ("version", "pid"))
+
+    def families(self):
+        return [self.request_seconds, self.stage_seconds, self.errors, self.model_info, *self.counters.values()]
+
+    def stage(self, name):
+        if not self.enabled:
+            return NULL_STAGE
+        return Stage(self, name)
+
+    def inc(self, name, amount=1, *label_values):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name].inc(amount, *label_values)
+
+    def error(self, stage):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.errors.inc(1, stage)
+
+    def observe_request(self, endpoint, status, seconds):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.request_seconds.observe(seconds, endpoint, status)
+            if self.multiprocess_dir and self._flusher_pid != os.getpid():
+                # Started on first use so that each forked worker runs its own
+                self._flusher_pid = os.getpid()
+                threading.Thread(target=self._flush, name="metrics-flush", daemon=True).start()
+
+    def set_model_version(self, version):
+        with self.lock:
+            self.model_info.clear()
+            self.model_info.set(1, version, os.getpid())
+
+    def server_timing_header(self):
+        """Server-Timing value for the stages timed in this request, or None."""
+        timings = g.get("stage_timings")
+        if not timings:
+            return None
+        return ", ".join(f"{name};dur={elapsed * 1000:.1f}" for name, elapsed in timings)
+
+    def snapshot(self):
+        """This registry as JSON, for merge() in another process."""
+        with self.lock:
+            return json.dumps({
+                family.name: [[list(label_values), value] for label_values, value in family.values.items()]
+                for family in self.families()
+            })
+
+    def merge(self, snapshot, gauges=True):
+        """Add a snapshot's counters and histograms to this registry, and take its gauges unless told not to."""
+        with self.lock:
+            for family in self.families():
+                if family.kind == "gauge" and not gauges:
+                    continue
+                for label_values, value in snapshot.get(family.name, []):
+                    family.merge(tuple(label_values), value)
+
+    def write_snapshot(self):
+        """Write this process's snapshot into multiprocess_dir."""
+        if not self.multiprocess_dir:
+            return
+        write_atomically(process_file(self.multiprocess_dir, os.getpid()), self.snapshot())
+
+    def _flush(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.write_snapshot()
+            except OSError as e:
+                print(f"Could not write metrics snapshot: {str(e)}")
+
+    def render(self):
+        if not self.multiprocess_dir:
+            return self._render()
+        self.write_snapshot()
+        merged = Metrics()
+        with directory_lock(self.multiprocess_dir, fcntl.LOCK_SH):
+            for name in os.listdir(self.multiprocess_dir):
+                if name == ARCHIVE_FILE or (name.startswith(PROCESS_FILE_PREFIX) and name.endswith(".json")):
+                    snapshot = read_snapshot(os.path.join(self.multiprocess_dir, name))
+                    if snapshot is not None:
+                        merged.merge(snapshot)
+        return merged._render()
+
+    def _render(self):
+        lines = []
+        with self.lock:
+            for family in self.families():
+                lines.append(f"# HELP {family.name} {family.help_text}")
+                lines.append(f"# TYPE {family.name} {family.kind}")
+                lines.extend(family.samples())
+        return "\n".join(lines) + "\n"
+
+
+# Files in a Metrics multiprocess_dir: one snapshot per live process, the merged counters
+# and histograms of exited ones, and a lock that keeps readers from seeing a process in both
+PROCESS_FILE_PREFIX = "process-"
+ARCHIVE_FILE = "archive.json"
+LOCK_FILE = ".lock"
+
+
+def process_file(multiprocess_dir, pid):
+    return os.path.join(multiprocess_dir, f"{PROCESS_FILE_PREFIX}{pid}.json")
+
+
+def write_atomically(path, text):
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    with open(tmp_path, "w") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+def read_snapshot(path):
+    """A snapshot file's contents, or None if it has gone."""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+@contextmanager
+def directory_lock(multiprocess_dir, operation):
+    with open(os.path.join(multiprocess_dir, LOCK_FILE), "a") as f:
+        fcntl.flock(f, operation)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def mark_process_dead(multiprocess_dir, pid):
+    """Fold an exited process's counters and histograms into the archive and drop its gauges."""
+    with directory_lock(multiprocess_dir, fcntl.LOCK_EX):
+        snapshot = read_snapshot(process_file(multiprocess_dir, pid))
+        if snapshot is None:
+            return
+        archive = Metrics()
+        archive_path = os.path.join(multiprocess_dir, ARCHIVE_FILE)
+        archived = read_snapshot(archive_path)
+        if archived is not None:
+            archive.merge(archived)
+        archive.merge(snapshot, gauges=False)
+        write_atomically(archive_path, archive.snapshot())
+        os.remove(process_file(multiprocess_dir, pid))
+
+
+def clear_multiprocess_dir(multiprocess_dir):
+    """Create multiprocess_dir, removing snapshots left by an earlier server."""
+    os.makedirs(multiprocess_dir, exist_ok=True)
+    for name in os.listdir(multiprocess_dir):
+        if name == ARCHIVE_FILE or name.startswith(PROCESS_FILE_PREFIX):
+            os.remove(os.path.join(multiprocess_dir, name))
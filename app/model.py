@@ -2,51 +2,87 @@ import pandas as pd
 import numpy as np
 from sklearn.model_selection import train_test_split
 from sklearn.ensemble import RandomForestRegressor
-from sklearn.preprocessing import LabelEncoder
 from sklearn.metrics import mean_squared_error, r2_score
+import argparse
+import hashlib
 import os
 import pickle
+import resource
 import time
+from features import FEATURE_COLUMNS
+from forest import FlatForest
+from seed import COLUMN_DTYPES
 
 
-def load_and_preprocess_data(file_path="data/user_activity_dataset.csv"):
+TARGET_COLUMN = "target"
+
+
+def feature_cache_paths(file_path):
+    base = file_path.rstrip("/")
+    return f"{base}.features.npy", f"{base}.target.npy"
+
+
+def source_mtime(file_path):
+    """Last modification of the data the feature cache is built from."""
+    if os.path.isdir(file_path):
+        return max(os.path.getmtime(os.path.join(file_path, f"{col}.npy"))
+                   for col in FEATURE_COLUMNS + [TARGET_COLUMN])
+    return os.path.getmtime(file_path)
+
+
+def read_feature_columns(file_path):
+    """Read only the feature and target columns, from per-column .npy files or the CSV.
+
+    Returns a float32 feature matrix (booleans as 0/1, as the LabelEncoders produced)
+    and the uint8 target.
+    """
+    if os.path.isdir(file_path):
+        target = np.load(os.path.join(file_path, f"{TARGET_COLUMN}.npy"), mmap_mode='r')
+        X = np.empty((len(target), len(FEATURE_COLUMNS)), dtype=np.float32)
+        for index, col in enumerate(FEATURE_COLUMNS):
+            X[:, index] = np.load(os.path.join(file_path, f"{col}.npy"), mmap_mode='r')
+        return X, np.asarray(target)
+
+    columns = FEATURE_COLUMNS + [TARGET_COLUMN]
+    df = pd.read_csv(file_path, usecols=columns, dtype={col: COLUMN_DTYPES[col] for col in columns})
+    return df[FEATURE_COLUMNS].to_numpy(dtype=np.float32), df[TARGET_COLUMN].to_numpy(dtype=np.uint8)
+
+
+def load_feature_matrix(file_path, use_cache=True):
+    """Feature matrix and target, memory-mapped from the preprocessed cache when it is fresh."""
+    features_path, target_path = feature_cache_paths(file_path)
+    if use_cache and os.path.exists(features_path) and os.path.exists(target_path) \
+            and os.path.getmtime(features_path) >= source_mtime(file_path):
+        print(f"Loading cached features from {features_path}...")
+        return np.load(features_path, mmap_mode='r'), np.load(target_path, mmap_mode='r')
+
+    print(f"Loading data from {file_path}...")
+    X, target = read_feature_columns(file_path)
+    if use_cache:
+        np.save(features_path, X)
+        np.save(target_path, target)
+    return X, target
+
+
+def load_and_preprocess_data(file_path="data/user_activity_dataset.csv", use_cache=True):
     """Load and preprocess the dataset."""
-    print("Loading data...")
-    df = pd.read_csv(file_path)
-
-    feature_columns = [
-        "headless", "cookiesEnabled", "pageLoadTime",
-        "event_mousemove", "event_keydown", "event_scroll", "event_copy",
-        "ip_is_datacenter", "screen_width", "screen_height",
-        "screen_devicePixelRatio", "viewport_innerWidth", "viewport_innerHeight",
-        "battery_level", "battery_charging", "battery_chargingTime",
-        "hardware_cpuCores", "hardware_deviceMemory"
-    ]
-    target_column = "target"
-
-    categorical_cols = ["headless", "cookiesEnabled", "event_mousemove", "event_keydown",
-                        "event_scroll", "event_copy", "ip_is_datacenter", "battery_charging"]
-    le_dict = {}
-    for col in categorical_cols:
-        le = LabelEncoder()
-        df[col] = le.fit_transform(df[col])
-        le_dict[col] = le
-
-    X = df[feature_columns]
-    y = df[target_column].apply(lambda x: 0 if x == 1 else 100)
+    X, target = load_feature_matrix(file_path, use_cache=use_cache)
+    y = np.where(target == 1, 0.0, 100.0)
 
     X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=42)
 
-    return X_train, X_test, y_train, y_test, feature_columns, le_dict
+    return X_train, X_test, y_train, y_test, FEATURE_COLUMNS
 
 
-def train_random_forest_regressor(X_train, X_test, y_train, y_test, feature_columns):
+def train_random_forest_regressor(X_train, X_test, y_train, y_test, feature_columns,
+                                  n_estimators=100, n_jobs=-1, max_samples=None):
     """Train a Random Forest Regressor and evaluate it."""
     rf_model = RandomForestRegressor(
-        n_estimators=100,
+        n_estimators=n_estimators,
         max_depth=10,
         random_state=42,
-        n_jobs=-1
+        n_jobs=n_jobs,
+        max_samples=max_samples
     )
 
     print("Training Random Forest Regressor model...")
@@ -73,34 +109,163 @@ def train_random_forest_regressor(X_train, X_test, y_train, y_test, feature_colu
 
     print("\nSample Predictions (0 = Sharp, 100 = Square):")
     for i in range(5):
-        print(f"Sample {i + 1}: Predicted Score = {y_pred[i]:.2f}, Actual Score = {y_test.iloc[i]}")
+        print(f"Sample {i + 1}: Predicted Score = {y_pred[i]:.2f}, Actual Score = {y_test[i]:.0f}")
 
     return rf_model
 
 
-def save_model(model, file_path="rf_regressor_model.pkl"):
-    """Save the trained model to a file."""
+def save_model(model, file_path="rf_regressor_model.pkl", flat_path=None):
+    """Save the trained model to a file.
+
+    With a flat_path the trees are also exported as memory-mappable node arrays, tagged
+    with the pickle's version so both artifacts share prediction caches and aggregates.
+    """
+    model_bytes = pickle.dumps(model)
     with open(file_path, 'wb') as f:
-        pickle.dump(model, f)
+        f.write(model_bytes)
     print(f"Model saved to {file_path}")
+    if flat_path:
+        FlatForest.from_sklearn(model, hashlib.sha256(model_bytes).hexdigest()[:12]).save(flat_path)
+        print(f"Flat model saved to {flat_path}")
+
+
+def iter_dataset_chunks(file_path, chunk_rows=1000000):
+    """Stream (float32 features, uint8 target) chunks without loading the whole dataset."""
+    if os.path.isdir(file_path):
+        target = np.load(os.path.join(file_path, f"{TARGET_COLUMN}.npy"), mmap_mode='r')
+        columns = [np.load(os.path.join(file_path, f"{col}.npy"), mmap_mode='r') for col in FEATURE_COLUMNS]
+        for start in range(0, len(target), chunk_rows):
+            X = np.empty((min(chunk_rows, len(target) - start), len(FEATURE_COLUMNS)), dtype=np.float32)
+            for index, column in enumerate(columns):
+                X[:, index] = column[start:start + chunk_rows]
+            yield X, np.asarray(target[start:start + chunk_rows])
+        return
+
+    columns = FEATURE_COLUMNS + [TARGET_COLUMN]
+    reader = pd.read_csv(file_path, usecols=columns, dtype={col: COLUMN_DTYPES[col] for col in columns},
+                         chunksize=chunk_rows)
+    for df in reader:
+        yield df[FEATURE_COLUMNS].to_numpy(dtype=np.float32), df[TARGET_COLUMN].to_numpy(dtype=np.uint8)
+
+
+class ClassReservoir:
+    """Uniform sample of up to capacity rows of one class, kept with Algorithm R."""
 
+    def __init__(self, capacity, rng):
+        self.capacity = capacity
+        self.rng = rng
+        self.rows = np.empty((capacity, len(FEATURE_COLUMNS)), dtype=np.float32)
+        self.seen = 0
 
-def build_and_train_model():
-    """Main function to build and return the trained model."""
-    if not os.path.exists("data"):
-        raise FileNotFoundError("Data directory not found. Please ensure 'data/user_activity_dataset.csv' exists.")
+    def add(self, X):
+        filled = min(self.seen, self.capacity)
+        direct = min(self.capacity - filled, len(X))
+        self.rows[filled:filled + direct] = X[:direct]
+        rest = X[direct:]
+        if len(rest):
+            # Row i (0-based over the stream) replaces a random slot with probability capacity / (i + 1);
+            # with repeated slots the later row wins, as it would in the sequential algorithm
+            positions = self.seen + direct + np.arange(len(rest))
+            slots = self.rng.integers(0, positions + 1)
+            accepted = slots < self.capacity
+            self.rows[slots[accepted]] = rest[accepted]
+        self.seen += len(X)
 
-    X_train, X_test, y_train, y_test, feature_columns, le_dict = load_and_preprocess_data()
+    def sample(self, size):
+        held = min(self.seen, self.capacity)
+        return self.rows[self.rng.choice(held, size=min(size, held), replace=False)]
 
-    trained_model = train_random_forest_regressor(X_train, X_test, y_train, y_test, feature_columns)
 
-    save_model(trained_model)
+def stratified_reservoir_sample(chunks, sample_size, seed=42):
+    """One pass over the chunks keeping a sample of sample_size rows with the stream's class mix.
+
+    Each class keeps its own reservoir of sample_size rows; at the end every class
+    contributes in proportion to how often it was seen.
+    """
+    rng = np.random.default_rng(seed)
+    reservoirs = {}
+    for X, target in chunks:
+        for label in np.unique(target):
+            if label not in reservoirs:
+                reservoirs[label] = ClassReservoir(sample_size, rng)
+            reservoirs[label].add(X[target == label])
+
+    total = sum(reservoir.seen for reservoir in reservoirs.values())
+    parts_X, parts_target = [], []
+    for label, reservoir in sorted(reservoirs.items()):
+        rows = reservoir.sample(int(round(sample_size * reservoir.seen / total)))
+        parts_X.append(rows)
+        parts_target.append(np.full(len(rows), label, dtype=np.uint8))
+    return np.concatenate(parts_X), np.concatenate(parts_target), total
+
+
+def peak_memory_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def train_out_of_core(file_path, sample_size, n_estimators=100, n_jobs=-1, max_samples=None, chunk_rows=1000000):
+    """Train on a stratified reservoir sample streamed from a dataset of any size.
+
+    Only one chunk and the class reservoirs are in memory at a time. max_samples further
+    bounds each tree's bootstrap sample.
+    """
+    print(f"Sampling {sample_size} rows from {file_path} in chunks of {chunk_rows}...")
+    start_time = time.time()
+    X, target, total = stratified_reservoir_sample(iter_dataset_chunks(file_path, chunk_rows), sample_size)
+    print(f"Sampled {len(X)} of {total} rows in {time.time() - start_time:.1f} seconds "
+          f"(peak memory {peak_memory_mb():.0f} MB)")
+
+    y = np.where(target == 1, 0.0, 100.0)
+    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=42)
+    del X, y
+
+    trained_model = train_random_forest_regressor(X_train, X_test, y_train, y_test, FEATURE_COLUMNS,
+                                                  n_estimators=n_estimators, n_jobs=n_jobs,
+                                                  max_samples=max_samples)
+    print(f"Peak memory: {peak_memory_mb():.0f} MB")
+    return trained_model
+
+
+def build_and_train_model(file_path="data/user_activity_dataset.csv", sample_size=None, flat_path=None,
+                          **training_options):
+    """Main function to build and return the trained model.
+
+    With a sample_size the dataset is streamed and the forest trained on a sample of it,
+    for datasets that do not fit in memory.
+    """
+    if not os.path.exists(file_path):
+        raise FileNotFoundError(f"Dataset not found. Please ensure '{file_path}' exists (see seed.py).")
+
+    if sample_size:
+        trained_model = train_out_of_core(file_path, sample_size, **training_options)
+    else:
+        training_options.pop("chunk_rows", None)
+        X_train, X_test, y_train, y_test, feature_columns = load_and_preprocess_data(file_path)
+        trained_model = train_random_forest_regressor(X_train, X_test, y_train, y_test, feature_columns,
+                                                      **training_options)
+
+    save_model(trained_model, flat_path=flat_path)
 
     return trained_model
 
 
 if __name__ == "__main__":
-    model = build_and_train_model()
+    parser = argparse.ArgumentParser(description="Train the Random Forest scoring model.")
+    parser.add_argument("--data", default="data/user_activity_dataset.csv",
+                        help="CSV file, or directory of per-column .npy files from seed.py --format npy")
+    parser.add_argument("--sample-size", type=int, default=None,
+                        help="Stream the dataset and train on a stratified sample of this many rows")
+    parser.add_argument("--chunk-rows", type=int, default=1000000, help="Rows read per chunk when sampling")
+    parser.add_argument("--n-estimators", type=int, default=100)
+    parser.add_argument("--n-jobs", type=int, default=-1)
+    parser.add_argument("--max-samples", type=int, default=None, help="Bootstrap sample size of each tree")
+    parser.add_argument("--flat", nargs="?", const="rf_regressor_model.flat", default=None,
+                        help="Also export the memory-mappable flat model (MODEL_FORMAT=flat) to this directory")
+    args = parser.parse_args()
+
+    model = build_and_train_model(args.data, sample_size=args.sample_size, flat_path=args.flat,
+                                  n_estimators=args.n_estimators, n_jobs=args.n_jobs,
+                                  max_samples=args.max_samples, chunk_rows=args.chunk_rows)
 
     # Example of how to use the model
     print("\nModel is ready for use")
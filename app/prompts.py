@@ -0,0 +1,87 @@
+from datetime import datetime
+import numpy as np
+from features import FEATURE_COLUMNS, FEATURE_FIELDS
+
+
+# Fields the history summary reads besides the features
+SUMMARY_FIELDS = ["timestamp", "fingerprint", "timezone", "ipDetails.asn"]
+SUMMARY_PROJECTION = {field: 1 for field in FEATURE_FIELDS + SUMMARY_FIELDS}
+SUMMARY_PROJECTION["_id"] = 0
+
+
+NUM_SAMPLES = 3
+
+
+COLUMN = {name: index for index, name in enumerate(FEATURE_COLUMNS)}
+
+
+def percent(features, column):
+    return f"{features[:, COLUMN[column]].mean() * 100:.0f}%"
+
+
+def value_range(features, column, fmt="{:.0f}"):
+    values = features[:, COLUMN[column]]
+    low, median, high = np.percentile(values, [0, 50, 100])
+    return f"median {fmt.format(median)} (range {fmt.format(low)}-{fmt.format(high)})"
+
+
+def most_common(values):
+    unique, counts = np.unique(values, axis=0, return_counts=True)
+    return unique[counts.argmax()], counts.max() / len(values)
+
+
+def distinct(user_records, field):
+    path = field.split(".")
+
+    def lookup(record):
+        for key in path:
+            record = record.get(key) if isinstance(record, dict) else None
+        return record
+
+    return len({lookup(record) for record in user_records})
+
+
+def format_time(timestamp):
+    return datetime.utcfromtimestamp(timestamp / 1000).strftime("%Y-%m-%d %H:%M UTC")
+
+
+def format_sample(row):
+    return ", ".join(f"{name}={value:g}" for name, value in zip(FEATURE_COLUMNS, row))
+
+
+def summarize_history(features, user_records):
+    """Condense a user's history into a fixed-size text summary for the LLM prompt.
+
+    Aggregates come straight from the feature matrix, so the summary costs a few vector
+    operations and stays the same size however many records the user has.
+    """
+    timestamps = np.array([record.get("timestamp", 0) for record in user_records], dtype=np.int64)
+    resolution, resolution_share = most_common(features[:, [COLUMN["screen_width"], COLUMN["screen_height"]]])
+    cpu_cores, _ = most_common(features[:, COLUMN["hardware_cpuCores"]])
+    device_memory, _ = most_common(features[:, COLUMN["hardware_deviceMemory"]])
+
+    # Oldest, middle and newest records by time
+    order = np.argsort(timestamps, kind="stable")
+    sample_indexes = order[np.unique(np.linspace(0, len(order) - 1, NUM_SAMPLES).astype(int))]
+
+    lines = [
+        f"Records: {len(features)} from {format_time(timestamps.min())} to {format_time(timestamps.max())}",
+        f"Headless browser: {percent(features, 'headless')} of sessions; "
+        f"cookies enabled: {percent(features, 'cookiesEnabled')}",
+        f"Page load time (ms): {value_range(features, 'pageLoadTime')}",
+        f"Interaction: mouse movement {percent(features, 'event_mousemove')}, "
+        f"key presses {percent(features, 'event_keydown')}, scrolling {percent(features, 'event_scroll')}, "
+        f"copying {percent(features, 'event_copy')} of sessions",
+        f"Datacenter IP: {percent(features, 'ip_is_datacenter')} of sessions",
+        f"Hardware: mostly {cpu_cores:.0f} CPU cores and {device_memory:.0f} GB memory; "
+        f"CPU cores {value_range(features, 'hardware_cpuCores')}",
+        f"Screen: {resolution[0]:.0f}x{resolution[1]:.0f} in {resolution_share * 100:.0f}% of sessions; "
+        f"pixel ratio {value_range(features, 'screen_devicePixelRatio', '{:g}')}",
+        f"Battery: level {value_range(features, 'battery_level', '{:.2f}')}, "
+        f"charging in {percent(features, 'battery_charging')} of sessions",
+        f"Setup changes: {distinct(user_records, 'fingerprint')} distinct fingerprints, "
+        f"{distinct(user_records, 'timezone')} timezones, {distinct(user_records, 'ipDetails.asn')} ASNs",
+        "Sample records (oldest, middle, newest):"
+    ]
+    lines += [f"- {format_sample(features[index])}" for index in sample_indexes]
+    return "\n".join(lines)
@@ -0,0 +1,139 @@
+import argparse
+import os
+import shutil
+import time
+from datetime import datetime
+import numpy as np
+from pymongo import MongoClient, ASCENDING
+from sklearn.metrics import mean_squared_error
+from features import FEATURE_PROJECTION, build_keyed_feature_matrix
+from model import save_model
+from forest import FlatForest
+from scoring import MODEL_PATH, load_model
+
+
+# Fingerprints are labelled like the training CSV: 1 for a sharp bettor, 0 otherwise
+LABEL_FIELD = os.getenv("MODEL_LABEL_FIELD", "target")
+REFRESH_PROJECTION = dict(FEATURE_PROJECTION, _id=1, **{LABEL_FIELD: 1})
+REFRESH_STATE_ID = "model_refresh"
+BATCH_SIZE = 1000
+
+
+def fetch_labelled_fingerprints(collection, last_id=None, limit=None):
+    """Feature matrix, scores and the last _id of labelled fingerprints written after last_id."""
+    query = {LABEL_FIELD: {"$exists": True}}
+    if last_id is not None:
+        query["_id"] = {"$gt": last_id}
+    cursor = collection.find(query, REFRESH_PROJECTION, batch_size=BATCH_SIZE).sort("_id", ASCENDING)
+    if limit:
+        cursor = cursor.limit(limit)
+    ids = []
+
+    def records():
+        for record in cursor:
+            ids.append(record["_id"])
+            yield record
+
+    X, labels = build_keyed_feature_matrix(records(), LABEL_FIELD, capacity=BATCH_SIZE)
+    y = np.where(np.asarray(labels) == 1, 0.0, 100.0)
+    return X, y, (ids[-1] if ids else last_id)
+
+
+def refresh_seed(random_state, generation):
+    """A seed for the trees of one refresh, derived from the model's random_state.
+
+    warm_start seeds the new trees from random_state after skipping one draw per existing
+    tree, and the forest keeps its size, so a fixed random_state would give every refresh
+    the same bootstrap and feature-sampling seeds. None stays None (fresh entropy).
+    """
+    if random_state is None:
+        return None
+    base = int(random_state) if isinstance(random_state, (int, np.integer)) else 0
+    return int(np.random.SeedSequence([base, generation]).generate_state(1)[0])
+
+
+def refresh_forest(model, X, y, new_trees, generation=1):
+    """Fit new_trees trees on (X, y) with warm_start and retire as many of the oldest ones.
+
+    The forest keeps its size, so prediction cost does not grow with each refresh, and
+    the retired trees are the ones fitted on the oldest data. generation numbers the
+    refresh, so that each one fits its trees with different seeds.
+    """
+    n_estimators = len(model.estimators_)
+    new_trees = min(new_trees, n_estimators)
+    random_state = model.random_state
+    model.set_params(warm_start=True, n_estimators=n_estimators + new_trees,
+                     random_state=refresh_seed(random_state, generation))
+    model.fit(X, y)
+    model.estimators_ = model.estimators_[new_trees:]
+    model.set_params(warm_start=False, n_estimators=n_estimators, random_state=random_state)
+    return model
+
+
+def versioned_path(model_path, version):
+    base, extension = os.path.splitext(model_path)
+    return f"{base}-{version}{extension}"
+
+
+def refresh_model_from_mongo(collection, state_collection, model_path=MODEL_PATH, new_trees=10,
+                             min_records=1000, max_records=None, holdout=0.2, flat_path=None):
+    """Grow the saved forest on the labelled fingerprints written since the last refresh.
+
+    Reads past the stored _id watermark, and does nothing until at least min_records
+    new labelled fingerprints are available. The refreshed model is written to a
+    versioned file next to model_path, then copied over model_path; the watermark only
+    advances once the model is saved. With a flat_path the flat artifact is rewritten
+    too. Returns the new model version, or None.
+    """
+    state = state_collection.find_one({"_id": REFRESH_STATE_ID}) or {}
+    start_time = time.time()
+    X, y, last_id = fetch_labelled_fingerprints(collection, state.get("lastId"), max_records)
+    if len(X) < min_records:
+        print(f"Only {len(X)} new labelled fingerprints, need {min_records}; not refreshing")
+        return None
+    print(f"Read {len(X)} labelled fingerprints in {time.time() - start_time:.1f} seconds")
+
+    model, version = load_model(model_path)
+    rng = np.random.default_rng(42)
+    test = rng.random(len(X)) < holdout
+    X_train, y_train = X[~test], y[~test]
+
+    start_time = time.time()
+    before = mean_squared_error(y[test], np.clip(model.predict(X[test]), 0, 100)) if test.any() else None
+    generation = state.get("generation", 0) + 1
+    refresh_forest(model, X_train, y_train, new_trees, generation)
+    print(f"Fitted {min(new_trees, model.n_estimators)} new trees on {len(X_train)} rows "
+          f"in {time.time() - start_time:.1f} seconds")
+    if before is not None:
+        after = mean_squared_error(y[test], np.clip(model.predict(X[test]), 0, 100))
+        print(f"Mean Squared Error on new held-out fingerprints: {before:.2f} -> {after:.2f}")
+
+    tmp_path = f"{model_path}.tmp"
+    save_model(model, tmp_path)
+    _, new_version = load_model(tmp_path)
+    shutil.copyfile(tmp_path, versioned_path(model_path, new_version))
+    os.replace(tmp_path, model_path)
+    if flat_path:
+        FlatForest.from_sklearn(model, new_version).save(flat_path)
+    state_collection.replace_one({"_id": REFRESH_STATE_ID}, {
+        "lastId": last_id, "modelVersion": new_version, "previousVersion": version,
+        "records": int(len(X)), "generation": generation, "refreshedAt": datetime.utcnow()
+    }, upsert=True)
+    print(f"Model refreshed: {version} -> {new_version}")
+    return new_version
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Refresh the model on new labelled fingerprints.")
+    parser.add_argument("--model", default=MODEL_PATH)
+    parser.add_argument("--new-trees", type=int, default=10, help="Trees fitted on the new data and retired from the oldest")
+    parser.add_argument("--min-records", type=int, default=1000)
+    parser.add_argument("--max-records", type=int, default=None, help="Read at most this many new fingerprints per refresh")
+    parser.add_argument("--flat", nargs="?", const="rf_regressor_model.flat", default=None,
+                        help="Also rewrite the flat model artifact in this directory")
+    args = parser.parse_args()
+
+    client = MongoClient(os.getenv("MONGO_URI"))
+    db = client.get_default_database()
+    refresh_model_from_mongo(db["fingerprints"], db["model_state"], args.model, new_trees=args.new_trees,
+                             min_records=args.min_records, max_records=args.max_records, flat_path=args.flat)
@@ -0,0 +1,224 @@
+import os
+import sys
+import time
+from datetime import datetime
+import numpy as np
+from pymongo import MongoClient, ASCENDING, ReturnDocument, UpdateOne, ReplaceOne
+from pymongo.errors import DuplicateKeyError, OperationFailure
+from features import FEATURE_PROJECTION, build_keyed_feature_matrix
+from scoring import scorer_from_env
+
+
+SCORE_PROJECTION = dict(FEATURE_PROJECTION, _id=1, userId=1, timestamp=1)
+BATCH_SIZE = int(os.getenv("SCORE_WORKER_BATCH_SIZE", "500"))
+POLL_INTERVAL = float(os.getenv("SCORE_WORKER_POLL_INTERVAL", "1.0"))
+
+
+def ensure_indexes(scores_collection):
+    """One aggregate document per user and model version."""
+    scores_collection.create_index([("userId", ASCENDING), ("modelVersion", ASCENDING)], unique=True)
+
+
+def aggregate_by_user(records, scorer):
+    """Score a batch of fingerprints and fold the scores into per-user aggregates."""
+    features, user_ids = build_keyed_feature_matrix(records, "userId", capacity=len(records))
+    scores = scorer.predict(features)
+    timestamps = np.array([record.get("timestamp", 0) for record in records], dtype=np.int64)
+
+    aggregates = {}
+    for user_id, score, timestamp in zip(user_ids, scores, timestamps):
+        aggregate = aggregates.get(user_id)
+        if aggregate is None:
+            aggregates[user_id] = {"sum": float(score), "count": 1, "min": float(score), "max": float(score),
+                                   "firstTimestamp": int(timestamp), "lastTimestamp": int(timestamp)}
+        else:
+            aggregate["sum"] += float(score)
+            aggregate["count"] += 1
+            aggregate["min"] = min(aggregate["min"], float(score))
+            aggregate["max"] = max(aggregate["max"], float(score))
+            aggregate["firstTimestamp"] = min(aggregate["firstTimestamp"], int(timestamp))
+            aggregate["lastTimestamp"] = max(aggregate["lastTimestamp"], int(timestamp))
+    return aggregates
+
+
+def apply_user_scores(scores_collection, records, scorer):
+    """Score newly written fingerprints once and add them to the users' running aggregates."""
+    if not records:
+        return
+    now = datetime.utcnow()
+    operations = [
+        UpdateOne(
+            {"userId": user_id, "modelVersion": scorer.version},
+            {
+                "$inc": {"sum": aggregate["sum"], "count": aggregate["count"]},
+                "$min": {"min": aggregate["min"], "firstTimestamp": aggregate["firstTimestamp"]},
+                "$max": {"max": aggregate["max"], "lastTimestamp": aggregate["lastTimestamp"]},
+                "$set": {"lastUpdated": now}
+            },
+            upsert=True
+        )
+        for user_id, aggregate in aggregate_by_user(records, scorer).items()
+    ]
+    scores_collection.bulk_write(operations, ordered=False)
+
+
+def backfill_user_scores(collection, scores_collection, state_collection, scorer):
+    """Re-score every fingerprint with the current model and replace its aggregates.
+
+    Run this when the model changes, before the worker for the new version. Fingerprints
+    up to the newest _id at the start are re-scored; the worker for this model version
+    then carries on from that _id. The version's state document is claimed first, so a
+    worker that already owns the version (and is building the same aggregates with $inc)
+    is never overwritten, and a worker started meanwhile waits for the backfill. Old
+    model versions' aggregates are removed at the end.
+    """
+    ensure_indexes(scores_collection)
+    newest = collection.find_one({}, {"_id": 1}, sort=[("_id", -1)])
+    if newest is None:
+        print("No fingerprints to backfill")
+        return
+    try:
+        state_collection.insert_one({"_id": scorer.version, "owner": "backfill"})
+    except DuplicateKeyError:
+        if (state_collection.find_one({"_id": scorer.version}) or {}).get("owner") != "backfill":
+            print(f"The score worker already owns model {scorer.version}; not backfilling")
+            return
+        # Replacing aggregates is idempotent, so an interrupted backfill can simply run again
+        print(f"Resuming an interrupted backfill for model {scorer.version}")
+    print(f"Backfilling user scores for model {scorer.version}...")
+    start_time = time.time()
+    totals = {}
+    batch = []
+    processed = 0
+    for record in collection.find({"_id": {"$lte": newest["_id"]}}, SCORE_PROJECTION, batch_size=BATCH_SIZE):
+        batch.append(record)
+        if len(batch) == BATCH_SIZE:
+            merge_aggregates(totals, aggregate_by_user(batch, scorer))
+            processed += len(batch)
+            batch = []
+    if batch:
+        merge_aggregates(totals, aggregate_by_user(batch, scorer))
+        processed += len(batch)
+
+    now = datetime.utcnow()
+    operations = [
+        ReplaceOne(
+            {"userId": user_id, "modelVersion": scorer.version},
+            dict(aggregate, userId=user_id, modelVersion=scorer.version, lastUpdated=now),
+            upsert=True
+        )
+        for user_id, aggregate in totals.items()
+    ]
+    scores_collection.bulk_write(operations, ordered=False)
+    state_collection.replace_one({"_id": scorer.version}, {"lastId": newest["_id"], "owner": "worker"})
+    scores_collection.delete_many({"modelVersion": {"$ne": scorer.version}})
+    print(f"Backfilled {len(totals)} users from {processed} fingerprints in {time.time() - start_time:.1f} seconds")
+
+
+def merge_aggregates(totals, aggregates):
+    for user_id, aggregate in aggregates.items():
+        total = totals.get(user_id)
+        if total is None:
+            totals[user_id] = aggregate
+        else:
+            total["sum"] += aggregate["sum"]
+            total["count"] += aggregate["count"]
+            total["min"] = min(total["min"], aggregate["min"])
+            total["max"] = max(total["max"], aggregate["max"])
+            total["firstTimestamp"] = min(total["firstTimestamp"], aggregate["firstTimestamp"])
+            total["lastTimestamp"] = max(total["lastTimestamp"], aggregate["lastTimestamp"])
+
+
+def catch_up(collection, scores_collection, state_collection, scorer, last_id):
+    """Score fingerprints past last_id in _id order; returns the last _id scored."""
+    while True:
+        query = {"_id": {"$gt": last_id}} if last_id is not None else {}
+        batch = list(collection.find(query, SCORE_PROJECTION).sort("_id", ASCENDING).limit(BATCH_SIZE))
+        if not batch:
+            return last_id
+        apply_user_scores(scores_collection, batch, scorer)
+        last_id = batch[-1]["_id"]
+        state_collection.update_one({"_id": scorer.version}, {"$set": {"lastId": last_id}}, upsert=True)
+
+
+def watch_fingerprints(collection, scores_collection, state_collection, scorer):
+    """Score inserts from the fingerprints change stream, resuming from the stored token.
+
+    Without a token the stream is opened first and everything past the stored _id (or
+    the whole collection) is caught up before consuming it; stream events at or below
+    the caught-up _id are skipped so nothing is counted twice.
+    """
+    state = state_collection.find_one({"_id": scorer.version}) or {}
+    pipeline = [{"$match": {"operationType": "insert"}}]
+    with collection.watch(pipeline, resume_after=state.get("resumeToken")) as stream:
+        last_id = None
+        saved_token = state.get("resumeToken")
+        if saved_token is None:
+            last_id = catch_up(collection, scores_collection, state_collection, scorer, state.get("lastId"))
+        print("Watching fingerprints change stream...")
+        while stream.alive:
+            batch = []
+            change = stream.try_next()
+            while change is not None:
+                document = change["fullDocument"]
+                if last_id is None or document["_id"] > last_id:
+                    batch.append(document)
+                if len(batch) == BATCH_SIZE:
+                    break
+                change = stream.try_next()
+            if batch:
+                apply_user_scores(scores_collection, batch, scorer)
+            if stream.resume_token is not None and stream.resume_token != saved_token:
+                saved_token = stream.resume_token
+                state_collection.update_one({"_id": scorer.version},
+                                            {"$set": {"resumeToken": saved_token}}, upsert=True)
+            if not batch:
+                time.sleep(POLL_INTERVAL)
+
+
+def poll_fingerprints(collection, scores_collection, state_collection, scorer):
+    """Fallback for a standalone mongod: score fingerprints past the last _id seen.
+
+    ObjectIds only roughly follow insertion order across writers, so this is a
+    best-effort mode; run a replica set for exact change-stream delivery.
+    """
+    print("Change streams unavailable, polling fingerprints by _id...")
+    last_id = (state_collection.find_one({"_id": scorer.version}) or {}).get("lastId")
+    while True:
+        last_id = catch_up(collection, scores_collection, state_collection, scorer, last_id)
+        time.sleep(POLL_INTERVAL)
+
+
+def claim_model_version(state_collection, scorer):
+    """Take over the model version's aggregates for the worker, waiting out a running backfill."""
+    state = state_collection.find_one_and_update({"_id": scorer.version}, {"$setOnInsert": {"owner": "worker"}},
+                                                 upsert=True, return_document=ReturnDocument.AFTER)
+    if state.get("owner") == "backfill":
+        print(f"Waiting for the backfill of model {scorer.version} to finish...")
+    while state.get("owner") == "backfill":
+        time.sleep(POLL_INTERVAL)
+        state = state_collection.find_one({"_id": scorer.version})
+
+
+def run_score_worker(collection, scores_collection, state_collection, scorer):
+    """Keep user_scores up to date as fingerprints are written."""
+    ensure_indexes(scores_collection)
+    claim_model_version(state_collection, scorer)
+    try:
+        watch_fingerprints(collection, scores_collection, state_collection, scorer)
+    except OperationFailure as e:
+        # Change streams need a replica set; the docker-compose mongod is standalone
+        print(f"Change stream failed: {str(e)}")
+        poll_fingerprints(collection, scores_collection, state_collection, scorer)
+
+
+if __name__ == "__main__":
+    mongo_uri = os.getenv("MONGO_URI")
+    client = MongoClient(mongo_uri)
+    db = client.get_default_database()
+    scorer = scorer_from_env(cache_size=0)
+
+    if len(sys.argv) > 1 and sys.argv[1] == "backfill":
+        backfill_user_scores(db["fingerprints"], db["user_scores"], db["score_worker_state"], scorer)
+    else:
+        run_score_worker(db["fingerprints"], db["user_scores"], db["score_worker_state"], scorer)
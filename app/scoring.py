@@ -0,0 +1,293 @@
+import os
+import json
+import pickle
+import hashlib
+import tempfile
+import threading
+import time
+import warnings
+from collections import deque
+import numpy as np
+from features import FEATURE_COLUMNS
+from forest import FlatForest
+from cache import PredictionCache
+
+
+# The model was fitted on a DataFrame; we score it with a plain float32 matrix in the same column order
+warnings.filterwarnings("ignore", message="X does not have valid feature names")
+
+
+MODEL_PATH = "rf_regressor_model.pkl"
+FLAT_MODEL_PATH = "rf_regressor_model.flat"
+
+
+def load_model(file_path=MODEL_PATH):
+    """Unpickle the model; its version is the first 12 hex digits of the file's sha256."""
+    with open(file_path, 'rb') as f:
+        model_bytes = f.read()
+    return pickle.loads(model_bytes), hashlib.sha256(model_bytes).hexdigest()[:12]
+
+
+class Scorer:
+    """Scores feature matrices with one model version through the configured engine and cache.
+
+    engine "sklearn" scores with model.predict, "flat" with the array-based FlatForest, and
+    "auto" uses FlatForest for up to flat_max_rows rows, where it avoids sklearn's thread
+    dispatch, and sklearn's multi-threaded predict above that. Without a sklearn model,
+    as when the forest is memory-mapped from a flat artifact, the engine is always "flat".
+    """
+
+    def __init__(self, model, version, engine="sklearn", flat_max_rows=2000, cache=None, flat_forest=None):
+        self.model = model
+        self.version = version
+        self.engine = engine if model is not None else "flat"
+        self.flat_max_rows = flat_max_rows
+        self.cache = cache
+        if flat_forest is None and self.engine in ("flat", "auto"):
+            flat_forest = FlatForest.from_sklearn(model, version)
+        self.flat_forest = flat_forest
+
+    def predict_rows(self, features):
+        """Score every row with the configured inference engine, bypassing the cache."""
+        if self.engine == "flat" or (self.engine == "auto" and len(features) <= self.flat_max_rows):
+            return self.flat_forest.predict(features)
+        return self.model.predict(features)
+
+    def predict(self, features):
+        """Score every row of a feature matrix."""
+        if self.cache is None:
+            return self.predict_rows(features)
+        return self.cache.predict(features, self.predict_rows, self.version)
+
+    def predict_mean(self, features):
+        """Mean score over the rows of a feature matrix."""
+        if self.cache is None:
+            return float(self.predict_rows(features).mean())
+        return self.cache.predict_mean(features, self.predict_rows, self.version)
+
+
+def model_artifact_path(model_path=MODEL_PATH):
+    """The file whose change marks a new model: the pickle, or the flat artifact's header."""
+    if os.getenv("MODEL_FORMAT", "pickle") == "flat":
+        return os.path.join(os.getenv("FLAT_MODEL_PATH", FLAT_MODEL_PATH), "forest.json")
+    return model_path
+
+
+def scorer_from_env(model_path=MODEL_PATH, cache_size=None, cache=None):
+    """Load the model and build a Scorer configured by PREDICT_ENGINE and friends.
+
+    With MODEL_FORMAT=flat the forest is memory-mapped from the flat artifact at
+    FLAT_MODEL_PATH (see model.py --flat) instead of unpickled. PREDICT_THREADS caps
+    sklearn's predict threads, which default to one per core. PREDICTION_CACHE_SIZE
+    turns on the PredictionCache; it is off by default because it only pays off when
+    users send repeated feature vectors, and on all-distinct rows it adds the key
+    building to every cold request. An existing PredictionCache can be passed in to be
+    shared with the previous model's Scorer.
+    """
+    flat_forest = None
+    if os.getenv("MODEL_FORMAT", "pickle") == "flat":
+        flat_forest = FlatForest.load(os.getenv("FLAT_MODEL_PATH", FLAT_MODEL_PATH))
+        model, version = None, flat_forest.version
+    else:
+        model, version = load_model(model_path)
+        if os.getenv("PREDICT_THREADS"):
+            model.set_params(n_jobs=int(os.getenv("PREDICT_THREADS")))
+    if cache is None:
+        if cache_size is None:
+            cache_size = int(os.getenv("PREDICTION_CACHE_SIZE", "0"))
+        cache = PredictionCache(cache_size) if cache_size > 0 else None
+    return Scorer(
+        model, version, flat_forest=flat_forest,
+        engine=os.getenv("PREDICT_ENGINE", "sklearn"),
+        flat_max_rows=int(os.getenv("FLAT_ENGINE_MAX_ROWS", "2000")),
+        cache=cache
+    )
+
+
+class ModelManager:
+    """Holds the live Scorer and swaps in new model versions without a restart.
+
+    Requests read current once and score with that Scorer throughout, so a swap never
+    changes the model under an in-flight request. reload() loads the artifact, warms it
+    and checks it on a canary batch before the single reference assignment that swaps
+    it in. The replaced Scorers are kept for rollback(). The prediction cache is shared
+    between versions; its keys already include the model version.
+
+    With a state_path, reload() and rollback() record the version they settle on and the
+    rolled-back versions in that file, and check() in every other process sharing it
+    (gunicorn workers) moves to the same version: from its own previous Scorers if it
+    still holds that version, otherwise by reloading the artifact.
+    """
+
+    def __init__(self, load, artifact_path, canary=None, max_drift=25.0, history=3, state_path=None):
+        self.load = load
+        self.artifact_path = artifact_path
+        self.canary = canary
+        self.max_drift = max_drift
+        self.current = None
+        self.previous = deque(maxlen=history)
+        self.rolled_back = set()
+        self.last_reload = None
+        self.reloads = 0
+        self.state_path = state_path
+        self._stamp = None
+        self._state_stamp = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def file_stamp(path):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def artifact_stamp(self):
+        return self.file_stamp(self.artifact_path)
+
+    def publish_state(self):
+        """Write the current and rolled-back versions to state_path for the other processes."""
+        if self.state_path is None or self.current is None:
+            return
+        state = {"version": self.current.version, "rolledBack": sorted(self.rolled_back)}
+        directory = os.path.dirname(os.path.abspath(self.state_path))
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".model-state-")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(state, f)
+            os.replace(temp_path, self.state_path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+        self._state_stamp = self.file_stamp(self.state_path)
+
+    def sync_state(self):
+        """Move to the version another process published in state_path; returns a status dict or None."""
+        if self.state_path is None:
+            return None
+        stamp = self.file_stamp(self.state_path)
+        if stamp is None or stamp == self._state_stamp:
+            return None
+        with self._lock:
+            try:
+                with open(self.state_path) as f:
+                    state = json.load(f)
+            except (OSError, ValueError) as e:
+                print(f"Could not read model state: {str(e)}")
+                return None
+            self._state_stamp = stamp
+            self.rolled_back = set(state["rolledBack"])
+            if self.current is None or self.current.version == state["version"]:
+                return None
+            for scorer in self.previous:
+                if scorer.version == state["version"]:
+                    self.previous.remove(scorer)
+                    status = {"status": "synced", "version": scorer.version, "previousVersion": self.current.version}
+                    if self.current.version not in self.rolled_back:
+                        self.previous.append(self.current)
+                    self.current = scorer
+                    print(f"Model sync: {status}")
+                    return status
+        # Not a version this process still holds; the artifact is, unless it was rolled back
+        return self.reload(publish=False)
+
+    def validate(self, candidate):
+        """Score the canary batch with the candidate; raises ValueError if it looks broken."""
+        features = self.canary() if self.canary is not None else None
+        if features is None or not len(features):
+            features = np.zeros((1, len(FEATURE_COLUMNS)), dtype=np.float32)
+        scores = candidate.predict_rows(features)
+        if len(scores) != len(features) or not np.all(np.isfinite(scores)):
+            raise ValueError("Canary scores are missing or not finite")
+        if scores.min() < 0 or scores.max() > 100:
+            raise ValueError(f"Canary scores outside 0-100: {scores.min():.1f} to {scores.max():.1f}")
+        if self.current is not None and self.max_drift is not None:
+            drift = abs(float(scores.mean()) - float(self.current.predict_rows(features).mean()))
+            if drift > self.max_drift:
+                raise ValueError(f"Canary mean score moved by {drift:.1f} points (limit {self.max_drift:g})")
+        return len(features)
+
+    def reload(self, force=False, publish=True):
+        """Load the artifact and swap it in if it is a new, valid version; returns a status dict.
+
+        Versions that were rolled back are skipped unless force is set. A swap is written to
+        state_path when publish is set.
+        """
+        with self._lock:
+            stamp = self.artifact_stamp()
+            start_time = time.monotonic()
+            status = {"previousVersion": self.current.version if self.current else None}
+            try:
+                candidate = self.load(self.current.cache if self.current else None)
+                status["version"] = candidate.version
+                if self.current is not None and candidate.version == self.current.version:
+                    status["status"] = "unchanged"
+                elif candidate.version in self.rolled_back and not force:
+                    status["status"] = "skipped"
+                    status["message"] = "Version was rolled back; reload with force to use it"
+                else:
+                    status["canaryRows"] = self.validate(candidate)
+                    if self.current is not None:
+                        self.previous.append(self.current)
+                    self.current = candidate
+                    self.rolled_back.discard(candidate.version)
+                    self.reloads += 1
+                    status["status"] = "swapped"
+                    if publish:
+                        self.publish_state()
+            except Exception as e:
+                status["status"] = "failed"
+                status["message"] = str(e)
+                if self.current is None:
+                    raise
+            finally:
+                self._stamp = stamp
+            status["seconds"] = round(time.monotonic() - start_time, 3)
+            self.last_reload = status
+            print(f"Model reload: {status}")
+            return status
+
+    def rollback(self):
+        """Swap back to the previous model version; returns a status dict."""
+        with self._lock:
+            if not self.previous:
+                return {"status": "failed", "message": "No previous model version to roll back to"}
+            rolled_back = self.current
+            self.current = self.previous.pop()
+            self.rolled_back.add(rolled_back.version)
+            self.publish_state()
+            status = {"status": "rolledBack", "version": self.current.version, "previousVersion": rolled_back.version}
+            print(f"Model rollback: {status}")
+            return status
+
+    def check(self, artifact=True):
+        """Follow the shared state, then reload if the artifact changed since it was last loaded.
+
+        Reloads picked up here are not published: every process sees the artifact change
+        itself, and publishing could overwrite a concurrent rollback.
+        """
+        status = self.sync_state()
+        if artifact and self.artifact_stamp() != self._stamp:
+            return self.reload(publish=False)
+        return status
+
+    def watch(self, interval, artifact=True):
+        """Check every interval seconds on a daemon thread; with artifact=False only the shared state."""
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.check(artifact=artifact)
+                except Exception as e:
+                    print(f"Model watch failed: {str(e)}")
+
+        threading.Thread(target=run, name="model-watch" if artifact else "model-state-watch", daemon=True).start()
+
+    def stats(self):
+        return {
+            "version": self.current.version if self.current else None,
+            "previousVersions": [scorer.version for scorer in self.previous],
+            "rolledBack": sorted(self.rolled_back),
+            "reloads": self.reloads,
+            "lastReload": self.last_reload
+        }
@@ -1,7 +1,11 @@
+import argparse
+import os
 import random
+import shutil
 import time
-import csv
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
+import numpy as np
 from faker import Faker
 
 
@@ -93,42 +97,275 @@ def generate_random_user_activity():
     return record
 
 
-def generate_csv_dataset(num_records=500000, output_file="user_activity_dataset.csv"):
-    """Generate a CSV dataset with random user activities and target labels."""
-    # Define CSV headers with target added
-    fieldnames = [
-        "userId", "timestamp", "timezone", "language", "headless", "cookiesEnabled",
-        "pageLoadTime", "event_mousemove", "event_keydown", "event_scroll", "event_copy",
-        "ip_country", "ip_asn", "ip_is_datacenter", "screen_width", "screen_height",
-        "screen_devicePixelRatio", "screen_orientation", "viewport_innerWidth", "viewport_innerHeight",
-        "battery_level", "battery_charging", "battery_chargingTime", "hardware_cpuCores",
-        "hardware_deviceMemory", "serverTimestamp", "target"
-    ]
+FIELDNAMES = [
+    "userId", "timestamp", "timezone", "language", "headless", "cookiesEnabled",
+    "pageLoadTime", "event_mousemove", "event_keydown", "event_scroll", "event_copy",
+    "ip_country", "ip_asn", "ip_is_datacenter", "screen_width", "screen_height",
+    "screen_devicePixelRatio", "screen_orientation", "viewport_innerWidth", "viewport_innerHeight",
+    "battery_level", "battery_charging", "battery_chargingTime", "hardware_cpuCores",
+    "hardware_deviceMemory", "serverTimestamp", "target"
+]
+
+
+CHUNK_SIZE = 100000
+HEX_DIGITS = np.frombuffer(b"0123456789abcdef", dtype="S1")
+
+
+def uuid4_strings(rng, size):
+    """Random version 4 UUID strings, formatted without a Python loop."""
+    raw = rng.integers(0, 256, size=(size, 16), dtype=np.uint8)
+    raw[:, 6] = (raw[:, 6] & 0x0F) | 0x40
+    raw[:, 8] = (raw[:, 8] & 0x3F) | 0x80
+    hex_digits = np.empty((size, 32), dtype="S1")
+    hex_digits[:, 0::2] = HEX_DIGITS[raw >> 4]
+    hex_digits[:, 1::2] = HEX_DIGITS[raw & 0x0F]
+    chars = np.full((size, 36), b"-", dtype="S1")
+    for start, end, offset in [(0, 8, 0), (8, 12, 1), (12, 16, 2), (16, 20, 3), (20, 32, 4)]:
+        chars[:, start + offset:end + offset] = hex_digits[:, start:end]
+    return chars.view("S36").ravel().astype(str)
+
+
+def determine_sharpness_vectorized(columns):
+    """determine_sharpness over whole columns; returns a uint8 array of 1 (sharp) / 0 (square)."""
+    cpu_cores = columns["hardware_cpuCores"]
+    device_memory = columns["hardware_deviceMemory"]
+    screen_area = columns["screen_width"].astype(np.int64) * columns["screen_height"]
+    battery_level = columns["battery_level"]
+
+    score = np.where(cpu_cores >= 16, 2.0, np.where(cpu_cores >= 8, 1.0, 0.0))
+    score += np.where(device_memory >= 64, 2.0, np.where(device_memory >= 32, 1.0, 0.0))
+    score += np.where(screen_area >= 2560 * 1440, 2.0, np.where(screen_area >= 1920 * 1080, 1.0, 0.0))
+    score += np.where(battery_level >= 0.75, 1.0, np.where(battery_level >= 0.5, 0.5, 0.0))
+    score += np.where(columns["screen_devicePixelRatio"] >= 2, 1.0, 0.0)
+    return (score >= 4).astype(np.uint8)
+
+
+def generate_columns(rng, size, timestamp_ms):
+    """Draw one chunk of the dataset as NumPy columns, same schema as generate_random_user_activity."""
+    resolution_index = rng.integers(0, len(resolutions), size)
+    screen_width = np.array([width for width, _ in resolutions])[resolution_index]
+    screen_height = np.array([height for _, height in resolutions])[resolution_index]
+    booleans = np.array([True, False])
+
+    columns = {
+        "userId": uuid4_strings(rng, size),
+        "timestamp": np.full(size, timestamp_ms, dtype=np.int64),
+        "timezone": rng.choice(timezones, size),
+        "language": rng.choice(languages, size),
+        "headless": rng.choice(booleans, size),
+        "cookiesEnabled": rng.choice(booleans, size),
+        "pageLoadTime": np.round(rng.uniform(50, 1000, size), 2),
+        "event_mousemove": rng.choice(booleans, size),
+        "event_keydown": rng.choice(booleans, size),
+        "event_scroll": rng.choice(booleans, size),
+        "event_copy": rng.choice(booleans, size),
+        "ip_country": rng.choice(countries, size),
+        "ip_asn": rng.choice(asns, size),
+        "ip_is_datacenter": rng.choice(booleans, size),
+        "screen_width": screen_width,
+        "screen_height": screen_height,
+        "screen_devicePixelRatio": rng.choice([1, 1.5, 2, 2.5, 3], size),
+        "screen_orientation": rng.choice(["landscape-primary", "portrait-primary"], size),
+        "viewport_innerWidth": screen_width - rng.integers(50, 401, size),
+        "viewport_innerHeight": screen_height - rng.integers(50, 401, size),
+        "battery_level": np.round(rng.uniform(0.05, 1.0, size), 2),
+        "battery_charging": rng.choice(booleans, size),
+        "battery_chargingTime": np.where(rng.choice(booleans, size), rng.integers(0, 7201, size), 0),
+        "hardware_cpuCores": rng.choice([2, 4, 6, 8, 12, 16, 24, 32], size),
+        "hardware_deviceMemory": rng.choice([4, 8, 16, 32, 64, 128], size),
+        "serverTimestamp": np.full(size, datetime.utcfromtimestamp(timestamp_ms / 1000).isoformat())
+    }
+    columns["target"] = determine_sharpness_vectorized(columns)
+    return columns
+
+
+def format_csv_rows(columns):
+    """Render a chunk of columns as CSV lines.
+
+    None of the values contain commas, quotes or newlines, so joining the stringified
+    columns is safe and a good deal faster than csv.writer or DataFrame.to_csv.
+    """
+    string_columns = []
+    for name in FIELDNAMES:
+        values = columns[name]
+        if values.dtype == bool:
+            values = np.where(values, "True", "False")
+        string_columns.append(values.astype(str).tolist())
+    return "".join(line + "\n" for line in map(",".join, zip(*string_columns)))
+
+
+def generate_csv_dataset(num_records=500000, output_file="user_activity_dataset.csv", seed=None,
+                         chunk_size=CHUNK_SIZE, timestamp_ms=None, verbose=True):
+    """Generate a CSV dataset with random user activities and target labels.
+
+    Rows are drawn column-wise with NumPy and written chunk by chunk, so memory stays
+    flat however many records are requested. Pass a seed (and a fixed timestamp_ms) for
+    a reproducible dataset.
+    """
+    rng = np.random.default_rng(seed)
+    if verbose:
+        print(f"Generating {num_records} records...")
+    start_time = time.time()
+
+    with open(output_file, 'w', newline='') as csvfile:
+        csvfile.write(",".join(FIELDNAMES) + "\n")
+        for start in range(0, num_records, chunk_size):
+            size = min(chunk_size, num_records - start)
+            columns = generate_columns(rng, size, timestamp_ms or int(time.time() * 1000))
+            csvfile.write(format_csv_rows(columns))
+
+            if verbose:
+                elapsed = time.time() - start_time
+                print(f"Generated {start + size} records ({(start + size) / num_records * 100:.1f}%) in {elapsed:.1f} seconds")
 
-    # Generate records
+    total_time = time.time() - start_time
+    if verbose:
+        print(f"Generated CSV dataset with {num_records} records in '{output_file}' in {total_time:.1f} seconds")
+
+
+COLUMN_DTYPES = {
+    "userId": "S36", "timestamp": np.int64, "timezone": "S16", "language": "S5",
+    "headless": np.bool_, "cookiesEnabled": np.bool_, "pageLoadTime": np.float32,
+    "event_mousemove": np.bool_, "event_keydown": np.bool_, "event_scroll": np.bool_, "event_copy": np.bool_,
+    "ip_country": "S2", "ip_asn": "S7", "ip_is_datacenter": np.bool_,
+    "screen_width": np.int16, "screen_height": np.int16, "screen_devicePixelRatio": np.float32,
+    "screen_orientation": "S17", "viewport_innerWidth": np.int16, "viewport_innerHeight": np.int16,
+    "battery_level": np.float32, "battery_charging": np.bool_, "battery_chargingTime": np.int16,
+    "hardware_cpuCores": np.uint8, "hardware_deviceMemory": np.uint8,
+    "serverTimestamp": "S26", "target": np.uint8
+}
+
+
+def create_npy_dataset(output_dir, num_records):
+    """Preallocate one .npy file per column, with the compact dtypes of COLUMN_DTYPES."""
+    os.makedirs(output_dir, exist_ok=True)
+    for name in FIELDNAMES:
+        np.lib.format.open_memmap(os.path.join(output_dir, f"{name}.npy"), mode='w+',
+                                  dtype=COLUMN_DTYPES[name], shape=(num_records,)).flush()
+
+
+def fill_npy_dataset(output_dir, start, num_records, seed=None, chunk_size=CHUNK_SIZE, timestamp_ms=None):
+    """Generate rows start..start+num_records straight into the preallocated column files."""
+    rng = np.random.default_rng(seed)
+    files = {name: np.load(os.path.join(output_dir, f"{name}.npy"), mmap_mode='r+') for name in FIELDNAMES}
+    for offset in range(0, num_records, chunk_size):
+        size = min(chunk_size, num_records - offset)
+        columns = generate_columns(rng, size, timestamp_ms or int(time.time() * 1000))
+        for name in FIELDNAMES:
+            files[name][start + offset:start + offset + size] = columns[name]
+    for column in files.values():
+        column.flush()
+
+
+def generate_npy_dataset(num_records=500000, output_dir="user_activity_dataset", seed=None,
+                         chunk_size=CHUNK_SIZE, timestamp_ms=None):
+    """Generate the dataset as a directory of per-column .npy files.
+
+    Training then reads only the columns it needs, memory-mapped, with no parsing.
+    """
     print(f"Generating {num_records} records...")
-    records = []
     start_time = time.time()
+    create_npy_dataset(output_dir, num_records)
+    fill_npy_dataset(output_dir, 0, num_records, seed=seed, chunk_size=chunk_size, timestamp_ms=timestamp_ms)
+    total_time = time.time() - start_time
+    print(f"Generated columnar dataset with {num_records} records in '{output_dir}' in {total_time:.1f} seconds")
 
-    for i in range(num_records):
-        record = generate_random_user_activity()
-        records.append(record)
 
-        # Progress update every 50,000 records
-        if (i + 1) % 50000 == 0:
-            elapsed = time.time() - start_time
-            print(f"Generated {i + 1} records ({(i + 1) / num_records * 100:.1f}%) in {elapsed:.1f} seconds")
+def part_file(output_file, shard_index):
+    return f"{output_file}.part-{shard_index:05d}"
 
-    # Write to CSV
-    with open(output_file, 'w', newline='') as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-        writer.writeheader()
-        writer.writerows(records)
+
+def generate_shard(shard):
+    """Process pool entry point: write one shard's part file, or its rows of the .npy columns."""
+    if shard["format"] == "npy":
+        fill_npy_dataset(shard["output"], shard["start"], shard["num_records"],
+                         seed=shard["seed"], timestamp_ms=shard["timestamp_ms"])
+        return shard["output"]
+    path = part_file(shard["output"], shard["index"])
+    generate_csv_dataset(num_records=shard["num_records"], output_file=path,
+                         seed=shard["seed"], timestamp_ms=shard["timestamp_ms"], verbose=False)
+    return path
+
+
+def merge_part_files(part_files, output_file):
+    """Concatenate part files in order into one CSV with a single header, removing the parts."""
+    with open(output_file, 'wb') as merged:
+        for index, path in enumerate(part_files):
+            with open(path, 'rb') as part:
+                header = part.readline()
+                if index == 0:
+                    merged.write(header)
+                shutil.copyfileobj(part, merged, length=16 * 1024 * 1024)
+            os.remove(path)
+
+
+def generate_sharded_dataset(num_records, output, seed=None, workers=1, shard_size=1000000,
+                             merge=True, timestamp_ms=None, file_format="csv"):
+    """Generate the dataset as fixed-size shards on a process pool.
+
+    Shard boundaries depend only on shard_size and shard i always draws from the seed
+    sequence SeedSequence(seed, spawn_key=(i,)), so the output is identical whatever the
+    number of workers. For CSV each shard is written to its own part file; with merge they
+    are concatenated in order into output. For npy the shards write their own row ranges
+    of the shared column files, so there is nothing to merge.
+    """
+    entropy = np.random.SeedSequence(seed).entropy
+    timestamp_ms = timestamp_ms or int(time.time() * 1000)
+    shards = [
+        {
+            "index": index,
+            "start": start,
+            "num_records": min(shard_size, num_records - start),
+            "output": output,
+            "format": file_format,
+            "seed": np.random.SeedSequence(entropy, spawn_key=(index,)),
+            "timestamp_ms": timestamp_ms
+        }
+        for index, start in enumerate(range(0, num_records, shard_size))
+    ]
+    print(f"Generating {num_records} records in {len(shards)} shards on {workers} workers "
+          f"(seed {entropy}, timestamp {timestamp_ms})...")
+    start_time = time.time()
+    if file_format == "npy":
+        create_npy_dataset(output, num_records)
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        part_files = []
+        for path in executor.map(generate_shard, shards):
+            part_files.append(path)
+            print(f"Wrote shard {len(part_files)}/{len(shards)} to {path} in {time.time() - start_time:.1f} seconds")
+
+    if merge and file_format == "csv":
+        merge_part_files(part_files, output)
+        print(f"Merged {len(part_files)} parts into '{output}'")
 
     total_time = time.time() - start_time
-    print(f"Generated CSV dataset with {num_records} records in '{output_file}' in {total_time:.1f} seconds")
+    print(f"Generated {num_records} records in {total_time:.1f} seconds ({num_records / total_time:,.0f} rows/sec)")
 
 
 if __name__ == "__main__":
-    # Generate CSV with 500,000 random records
-    generate_csv_dataset(num_records=500000, output_file="data/user_activity_dataset.csv")
+    parser = argparse.ArgumentParser(description="Generate the synthetic training dataset.")
+    parser.add_argument("--num-records", type=int, default=500000)
+    parser.add_argument("--format", choices=["csv", "npy"], default="csv",
+                        help="csv writes one file; npy writes a directory with one .npy file per column")
+    parser.add_argument("--output", default=None,
+                        help="Defaults to data/user_activity_dataset.csv, or data/user_activity_dataset for npy")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Generate shards on this many processes (reproducible for any count)")
+    parser.add_argument("--shard-size", type=int, default=1000000)
+    parser.add_argument("--no-merge", action="store_true", help="Keep one CSV part file per shard")
+    parser.add_argument("--timestamp", type=int, default=None, help="Fixed timestamp (ms) for every row")
+    args = parser.parse_args()
+    output = args.output or ("data/user_activity_dataset" if args.format == "npy" else "data/user_activity_dataset.csv")
+
+    if args.workers:
+        generate_sharded_dataset(args.num_records, output, seed=args.seed, workers=args.workers,
+                                 shard_size=args.shard_size, merge=not args.no_merge,
+                                 timestamp_ms=args.timestamp, file_format=args.format)
+    elif args.format == "npy":
+        generate_npy_dataset(num_records=args.num_records, output_dir=output, seed=args.seed,
+                             timestamp_ms=args.timestamp)
+    else:
+        generate_csv_dataset(num_records=args.num_records, output_file=output, seed=args.seed,
+                             timestamp_ms=args.timestamp)